@@ -0,0 +1,850 @@
+"""
+进程内模拟的 OpenStack 后端, 用于离线运行 os_compose 的 up/down 并统计 API 调用
+"""
+import re
+import json
+import time
+import hashlib
+import datetime
+import uuid
+import random
+import threading
+import tracemalloc
+from collections import Counter
+
+import netaddr
+import openstack
+from openstack import exceptions
+from keystoneauth1 import access
+
+
+class Resource:
+    """模拟 SDK 的资源对象, 同时支持属性访问和字典访问"""
+    def __init__(self, **attrs) -> None:
+        self.__dict__.update(attrs)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self) -> str:
+        return f"Resource({self.__dict__.get('name') or self.__dict__.get('id')})"
+
+
+def _rid(res):
+    """从资源对象或id中取id"""
+    return res if isinstance(res, str) else res.id
+
+
+def _match(res, query):
+    """按照查询参数过滤资源, name 按 Nova 的正则语义匹配"""
+    for key, value in query.items():
+        if value is None or key in ('details', 'all_projects', 'limit', 'marker'):
+            continue
+        if key == 'name' and getattr(res, 'status', None) is not None:
+            if re.search(str(value), res.name or '') is None:
+                return False
+            continue
+        if str(getattr(res, key, None)) != str(value):
+            return False
+    return True
+
+
+class FakeCloud:
+    """模拟云的全部状态, 可配置每次调用的延迟、虚拟机启动时间和错误注入
+
+    latency:    所有调用的默认延迟(秒)
+    latencies:  按 "service.method" 单独指定的延迟
+    boot_time:  虚拟机从 BUILD 到 ACTIVE 的时间
+    delete_time: 虚拟机从删除请求到真正消失的时间
+    error_rate: 按 "service.method" 指定的 503 错误注入概率
+    token_ttl:  token 的有效期(秒)
+    """
+    def __init__(self, latency=0.0, latencies=None, boot_time=0.0,
+                 delete_time=0.3, error_rate=None, seed=0,
+                 images=None, flavors=None, token_ttl=3600) -> None:
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.boot_time = boot_time
+        self.delete_time = delete_time
+        self.error_rate = error_rate or {}
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self._ids = random.Random(seed)
+        self.lock = threading.RLock()
+        self.calls = Counter()
+        self.projects = {}
+        self.servers = {}
+        self.networks = {}
+        self.subnets = {}
+        self.ports = {}
+        self.routers = {}
+        self.fips = {}
+        self.secgroups = {}
+        self.rules = {}
+        self.tokens = 0
+        self.users = {'admin': Resource(id=self.new_id(), name='admin')}
+        self.roles = {'admin': Resource(id=self.new_id(), name='admin')}
+        self.images = {}
+        self.flavors = {}
+        for name in images or ['cirros']:
+            self.add_image(name)
+        for name in flavors or ['m1.small']:
+            self.add_flavor(name)
+        admin = self._add_project('admin', '')
+        provider = Resource(id=self.new_id(), name='provider', project_id=admin.id,
+                            is_router_external=True, status='ACTIVE')
+        self.networks[provider.id] = provider
+        provider_subnet = Resource(id=self.new_id(), name='provider-subnet',
+                                   network_id=provider.id, project_id=admin.id,
+                                   cidr='192.0.2.0/24', gateway_ip='192.0.2.1',
+                                   allocation_pools=[{'start': '192.0.2.10',
+                                                      'end': '192.0.2.250'}])
+        self.subnets[provider_subnet.id] = provider_subnet
+        self.provider = provider
+        self._fip_pool = iter(netaddr.IPNetwork('198.18.0.0/15').iter_hosts())
+
+    def new_id(self):
+        """生成资源ID, 相同 seed 下镜像、配额等预置资源的ID保持不变"""
+        with self.lock:
+            return str(uuid.UUID(int=self._ids.getrandbits(128), version=4))
+
+    # ---- 注册资源 ----
+    def add_image(self, name):
+        image = Resource(id=self.new_id(), name=name)
+        self.images[image.id] = image
+        return image
+
+    def add_flavor(self, name):
+        flavor = Resource(id=self.new_id(), name=name)
+        self.flavors[flavor.id] = flavor
+        return flavor
+
+    def _add_project(self, name, description):
+        project = Resource(id=self.new_id(), name=name, description=description)
+        self.projects[project.id] = project
+        return project
+
+    # ---- 调用记录 ----
+    def call(self, endpoint):
+        """记录一次 API 调用, 模拟延迟并按概率注入错误"""
+        with self.lock:
+            self.calls[endpoint] += 1
+            failed = self.random.random() < self.error_rate.get(endpoint, 0.0)
+        delay = self.latencies.get(endpoint, self.latency)
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise exceptions.HttpException(
+                message=f'injected error on {endpoint}', http_status=503)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+
+    def connect(self, **auth):
+        """替代 openstack.connect, 和真实的连接一样在第一次请求时才认证"""
+        project_id = auth.get('project_id')
+        if project_id is None:
+            project = self._find(self.projects, auth.get('project_name', 'admin'))
+            project_id = project.id if project else None
+        return FakeConnection(self, project_id, auth)
+
+    def authenticate(self, project_id):
+        """模拟一次 Keystone 认证, 返回 token 信息"""
+        self.call('identity.authenticate')
+        with self.lock:
+            self.tokens += 1
+            token = f'token-{self.tokens}'
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.token_ttl)
+        body = {'token': {'expires_at': expires.strftime('%Y-%m-%dT%H:%M:%S.000000Z'),
+                          'methods': ['password'], 'catalog': [],
+                          'project': {'id': project_id, 'name': project_id, 'domain': {'id': 'default'}},
+                          'user': {'id': 'admin', 'name': 'admin', 'domain': {'id': 'default'}}}}
+        return access.create(body=body, auth_token=token)
+
+    def install(self):
+        """用本模拟后端替换 openstack.connect"""
+        self._original_connect = openstack.connect
+        openstack.connect = self.connect
+        return self
+
+    def uninstall(self):
+        openstack.connect = self._original_connect
+
+    def _find(self, table, name_or_id, **query):
+        with self.lock:
+            if name_or_id in table:
+                return table[name_or_id]
+            for res in table.values():
+                if res.name == name_or_id and _match(res, query):
+                    return res
+        return None
+
+    # ---- 模拟状态推进 ----
+    def tick(self):
+        """根据时间推进虚拟机状态"""
+        now = time.monotonic()
+        with self.lock:
+            for server in list(self.servers.values()):
+                if server.status == 'BUILD' and now >= server.ready_at:
+                    server.status = server.final_status
+                if server.status == 'DELETING' and now >= server.gone_at:
+                    del self.servers[server.id]
+                    for port in [p for p in self.ports.values() if p.device_id == server.id]:
+                        # 预先创建的端口只解除绑定, 不删除
+                        if getattr(port, 'preserve', False):
+                            port.device_id = ''
+                            port.device_owner = ''
+                        else:
+                            self._release_port(port.id)
+
+    @staticmethod
+    def _remove_address(server, address):
+        for name in list(server.addresses):
+            server.addresses[name] = [addr for addr in server.addresses[name] if addr['addr'] != address]
+            if not server.addresses[name]:
+                del server.addresses[name]
+
+    def _port_server(self, port_id):
+        port = self.ports.get(port_id) if port_id else None
+        return (port, self.servers.get(port.device_id)) if port is not None else (None, None)
+
+    def _bind_floating(self, fip):
+        """与 Nova 相同, 绑定的浮动ip也列在虚拟机的 addresses 中"""
+        port, server = self._port_server(fip.port_id)
+        if server is not None:
+            server.addresses.setdefault(self.networks[port.network_id].name, []).append(
+                {'addr': fip.floating_ip_address, 'OS-EXT-IPS:type': 'floating'})
+
+    def _unbind_floating(self, fip):
+        _, server = self._port_server(fip.port_id)
+        if server is not None:
+            self._remove_address(server, fip.floating_ip_address)
+
+    def _release_port(self, port_id):
+        for fip in self.fips.values():
+            if fip.port_id == port_id:
+                self._unbind_floating(fip)
+        port = self.ports.pop(port_id)
+        for fip in self.fips.values():
+            if fip.port_id == port_id:
+                fip.port_id = None
+                fip.fixed_ip_address = None
+                fip.status = 'DOWN'
+        return port
+
+    def allocate_ip(self, subnet, fixed_ip=None):
+        """在子网中分配一个ip, 冲突时抛出 BadRequestException"""
+        used = {p.fixed_ips[0]['ip_address'] for p in self.ports.values()
+                if p.fixed_ips and p.fixed_ips[0]['subnet_id'] == subnet.id}
+        if fixed_ip is not None:
+            fixed_ip = str(fixed_ip)
+            if fixed_ip in used:
+                raise exceptions.BadRequestException(
+                    message=f'IP address {fixed_ip} already allocated in subnet {subnet.id}')
+            return fixed_ip
+        for pool in subnet.allocation_pools:
+            for ip in netaddr.iter_iprange(pool['start'], pool['end']):
+                if str(ip) not in used:
+                    return str(ip)
+        raise exceptions.ConflictException(message=f'No more IP addresses on {subnet.id}')
+
+
+class FakeConnection:
+    """模拟 openstack.connection.Connection"""
+    def __init__(self, cloud, project_id, auth=None) -> None:
+        self.cloud = cloud
+        self.project_id = project_id
+        self.session = FakeSession(self, FakeAuth(cloud, project_id, auth or {}))
+        self.compute = FakeCompute(self)
+        self.network = FakeNetwork(self)
+        self.identity = FakeIdentity(self)
+        self.image = FakeImage(self)
+
+    def close(self):
+        pass
+
+
+class FakeAuth:
+    """模拟 keystoneauth 的认证插件, 支持保存和装入认证状态"""
+    def __init__(self, cloud, project_id, auth) -> None:
+        self._cloud = cloud
+        self._project_id = project_id
+        self._auth = auth
+        self.auth_ref = None
+
+    def get_cache_id(self):
+        data = json.dumps(self._auth, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get_access(self):
+        if self.auth_ref is None or self.auth_ref.will_expire_soon(30):
+            self.auth_ref = self._cloud.authenticate(self._project_id)
+        return self.auth_ref
+
+    def invalidate(self):
+        self.auth_ref = None
+        return True
+
+    def get_auth_state(self):
+        if self.auth_ref is None:
+            return None
+        return json.dumps({'auth_token': self.auth_ref.auth_token, 'body': self.auth_ref._data})
+
+    def set_auth_state(self, data):
+        if not data:
+            self.auth_ref = None
+            return
+        data = json.loads(data)
+        self.auth_ref = access.create(body=data['body'], auth_token=data['auth_token'])
+
+
+class FakeSession:
+    def __init__(self, conn, auth) -> None:
+        self._conn = conn
+        self.auth = auth
+
+    def get_project_id(self):
+        return self._conn.project_id
+
+    def get_token(self):
+        return self.auth.get_access().auth_token
+
+
+class _Proxy:
+    service = ''
+
+    def __init__(self, conn) -> None:
+        self._conn = conn
+        self._cloud = conn.cloud
+
+    def _call(self, method):
+        # 第一次请求时认证
+        self._conn.session.get_token()
+        self._cloud.call(f'{self.service}.{method}')
+
+
+class FakeIdentity(_Proxy):
+    service = 'identity'
+
+    def create_project(self, name=None, description=None, **attrs):
+        self._call('create_project')
+        with self._cloud.lock:
+            if self._cloud._find(self._cloud.projects, name) is not None:
+                raise exceptions.ConflictException(message=f'project {name} exists')
+            return self._cloud._add_project(name, description)
+
+    def find_project(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_project')
+        return self._cloud._find(self._cloud.projects, name_or_id)
+
+    def projects(self, **query):
+        self._call('projects')
+        with self._cloud.lock:
+            return [p for p in self._cloud.projects.values() if _match(p, query)]
+
+    def delete_project(self, project, ignore_missing=True):
+        self._call('delete_project')
+        with self._cloud.lock:
+            self._cloud.projects.pop(_rid(project), None)
+
+    def find_user(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_user')
+        return self._cloud.users.get(name_or_id)
+
+    def find_role(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_role')
+        return self._cloud.roles.get(name_or_id)
+
+    def assign_project_role_to_user(self, project, user, role, **kwargs):
+        self._call('assign_project_role_to_user')
+
+
+class FakeImage(_Proxy):
+    service = 'image'
+
+    def images(self, **query):
+        self._call('images')
+        with self._cloud.lock:
+            return iter([i for i in self._cloud.images.values() if _match(i, query)])
+
+
+class FakeCompute(_Proxy):
+    service = 'compute'
+
+    def images(self, **query):
+        self._call('images')
+        with self._cloud.lock:
+            return iter([i for i in self._cloud.images.values() if _match(i, query)])
+
+    def flavors(self, **query):
+        self._call('flavors')
+        with self._cloud.lock:
+            return iter([f for f in self._cloud.flavors.values() if _match(f, query)])
+
+    def find_image(self, name_or_id, ignore_missing=True):
+        self._call('find_image')
+        return self._cloud._find(self._cloud.images, name_or_id)
+
+    def find_flavor(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_flavor')
+        return self._cloud._find(self._cloud.flavors, name_or_id)
+
+    def create_server(self, **attrs):
+        self._call('create_server')
+        cloud = self._cloud
+        with cloud.lock:
+            server = Resource(
+                id=self._cloud.new_id(), name=attrs['name'], project_id=self._conn.project_id,
+                image_id=attrs.get('image_id'), flavor_id=attrs.get('flavor_id'),
+                image={'id': attrs.get('image_id')},
+                flavor={'id': attrs.get('flavor_id'),
+                        'original_name': cloud.flavors[attrs['flavor_id']].name},
+                status='BUILD', final_status='ACTIVE', addresses={},
+                admin_password=uuid.uuid4().hex[:12],
+                security_groups=attrs.get('security_groups', []),
+                user_data=attrs.get('user_data'), metadata=dict(attrs.get('metadata') or {}),
+                ready_at=time.monotonic() + cloud.boot_time, gone_at=None,
+            )
+            ports = []
+            # networks='none' (微版本 2.37) 启动不带网卡的虚拟机
+            nics = attrs.get('networks') or []
+            for nic in ([] if isinstance(nics, str) else nics):
+                if 'port' in nic:
+                    port = cloud.ports[nic['port']]
+                    port.preserve = True
+                    if port.device_id:
+                        raise exceptions.ConflictException(message=f'port {port.id} in use')
+                else:
+                    network_id = nic['uuid']
+                    subnet = next(s for s in cloud.subnets.values()
+                                  if s.network_id == network_id)
+                    ip = cloud.allocate_ip(subnet, nic.get('fixed_ip'))
+                    port = Resource(id=self._cloud.new_id(), name='', network_id=network_id,
+                                    project_id=self._conn.project_id,
+                                    fixed_ips=[{'subnet_id': subnet.id, 'ip_address': ip}],
+                                    device_id='', device_owner='')
+                    cloud.ports[port.id] = port
+                ports.append(port)
+            for port in ports:
+                port.device_id = server.id
+                port.device_owner = 'compute:nova'
+                network = cloud.networks[port.network_id]
+                server.addresses.setdefault(network.name, []).append(
+                    {'addr': port.fixed_ips[0]['ip_address'], 'OS-EXT-IPS:type': 'fixed'})
+            cloud.servers[server.id] = server
+        return server
+
+    def get_server(self, server):
+        self._call('get_server')
+        self._cloud.tick()
+        found = self._cloud.servers.get(_rid(server))
+        if found is None:
+            raise exceptions.NotFoundException(message=f'server {_rid(server)} not found')
+        return found
+
+    def find_server(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_server')
+        self._cloud.tick()
+        return self._cloud._find(self._cloud.servers, name_or_id, **query)
+
+    def servers(self, details=True, all_projects=False, **query):
+        self._call('servers')
+        self._cloud.tick()
+        if not all_projects:
+            query.setdefault('project_id', self._conn.project_id)
+        with self._cloud.lock:
+            return iter([s for s in self._cloud.servers.values()
+                         if s.status != 'DELETED' and _match(s, query)])
+
+    def update_server(self, server, **attrs):
+        self._call('update_server')
+        with self._cloud.lock:
+            found = self._cloud.servers[_rid(server)]
+            found.__dict__.update(attrs)
+            return found
+
+    def rebuild_server(self, server, image, **attrs):
+        self._call('rebuild_server')
+        cloud = self._cloud
+        with cloud.lock:
+            found = cloud.servers[_rid(server)]
+            found.__dict__.update(attrs)
+            found.image = {'id': _rid(image)}
+            found.status = 'BUILD'
+            found.ready_at = time.monotonic() + cloud.boot_time
+            return found
+
+    def server_interfaces(self, server):
+        self._call('server_interfaces')
+        with self._cloud.lock:
+            return iter([Resource(id=p.id, port_id=p.id, server_id=_rid(server), net_id=p.network_id)
+                         for p in self._cloud.ports.values() if p.device_id == _rid(server)])
+
+    def create_server_interface(self, server, port_id=None, **attrs):
+        self._call('create_server_interface')
+        cloud = self._cloud
+        with cloud.lock:
+            found = cloud.servers[_rid(server)]
+            port = cloud.ports[port_id]
+            if port.device_id:
+                raise exceptions.ConflictException(message=f'port {port.id} in use')
+            port.preserve = True
+            port.device_id = found.id
+            port.device_owner = 'compute:nova'
+            network = cloud.networks[port.network_id]
+            found.addresses.setdefault(network.name, []).append(
+                {'addr': port.fixed_ips[0]['ip_address'], 'OS-EXT-IPS:type': 'fixed'})
+            return Resource(id=port.id, port_id=port.id, server_id=found.id, net_id=port.network_id)
+
+    def delete_server_interface(self, server_interface, server=None, ignore_missing=True):
+        self._call('delete_server_interface')
+        cloud = self._cloud
+        with cloud.lock:
+            port = cloud.ports.get(_rid(server_interface))
+            if port is None or port.device_id != _rid(server):
+                return None
+            for fip in cloud.fips.values():
+                if fip.port_id == port.id:
+                    cloud._unbind_floating(fip)
+            port.device_id = ''
+            port.device_owner = ''
+            cloud._remove_address(cloud.servers[_rid(server)], port.fixed_ips[0]['ip_address'])
+
+    def wait_for_server(self, server, status='ACTIVE', failures=None,
+                        interval=2, wait=120, callback=None):
+        failures = failures or ['ERROR']
+        deadline = time.monotonic() + (wait or 0)
+        while True:
+            found = self.get_server(server)
+            if found.status == status:
+                return found
+            if found.status in failures:
+                raise exceptions.ResourceFailure(f'{found.name} went to {found.status}')
+            if time.monotonic() >= deadline:
+                raise exceptions.ResourceTimeout(f'timeout waiting for {found.name}')
+            time.sleep(min(interval or 0.01, max(found.ready_at - time.monotonic(), 0.001)))
+
+    def delete_server(self, server, ignore_missing=True, force=False):
+        self._call('delete_server')
+        cloud = self._cloud
+        with cloud.lock:
+            found = cloud.servers.get(_rid(server))
+            if found is None:
+                if ignore_missing:
+                    return None
+                raise exceptions.NotFoundException(message='server not found')
+            found.status = 'DELETING'
+            found.gone_at = time.monotonic() + cloud.delete_time
+        cloud.tick()
+
+    def wait_for_delete(self, res, interval=2, wait=120, callback=None):
+        deadline = time.monotonic() + (wait or 0)
+        while True:
+            self._call('get_server')
+            self._cloud.tick()
+            if _rid(res) not in self._cloud.servers:
+                return res
+            if time.monotonic() >= deadline:
+                raise exceptions.ResourceTimeout('timeout waiting for delete')
+            time.sleep(min(interval or 0.01, 0.01))
+
+
+class FakeNetwork(_Proxy):
+    service = 'network'
+
+    def _list(self, table, query, method):
+        self._call(method)
+        with self._cloud.lock:
+            return iter([r for r in table.values() if _match(r, query)])
+
+    # ---- network ----
+    def networks(self, **query):
+        return self._list(self._cloud.networks, query, 'networks')
+
+    def find_network(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_network')
+        return self._cloud._find(self._cloud.networks, name_or_id, **query)
+
+    def get_network(self, network):
+        self._call('get_network')
+        return self._cloud.networks[_rid(network)]
+
+    def create_network(self, **attrs):
+        self._call('create_network')
+        network = Resource(**{'id': self._cloud.new_id(), 'project_id': self._conn.project_id,
+                              'is_router_external': False, 'status': 'ACTIVE', **attrs})
+        with self._cloud.lock:
+            self._cloud.networks[network.id] = network
+        return network
+
+    def delete_network(self, network, ignore_missing=True):
+        self._call('delete_network')
+        cloud = self._cloud
+        with cloud.lock:
+            network_id = _rid(network)
+            if any(p.network_id == network_id and p.device_owner != 'network:dhcp'
+                   for p in cloud.ports.values()):
+                raise exceptions.ConflictException(message=f'network {network_id} in use')
+            for subnet_id in [s.id for s in cloud.subnets.values()
+                              if s.network_id == network_id]:
+                del cloud.subnets[subnet_id]
+            cloud.networks.pop(network_id, None)
+
+    # ---- subnet ----
+    def subnets(self, **query):
+        return self._list(self._cloud.subnets, query, 'subnets')
+
+    def get_subnet(self, subnet):
+        self._call('get_subnet')
+        return self._cloud.subnets[_rid(subnet)]
+
+    def create_subnet(self, **attrs):
+        self._call('create_subnet')
+        subnet = Resource(id=self._cloud.new_id(), project_id=self._conn.project_id, **attrs)
+        with self._cloud.lock:
+            self._cloud.subnets[subnet.id] = subnet
+        return subnet
+
+    def delete_subnet(self, subnet, ignore_missing=True):
+        self._call('delete_subnet')
+        cloud = self._cloud
+        with cloud.lock:
+            subnet_id = _rid(subnet)
+            if any(p.fixed_ips and p.fixed_ips[0]['subnet_id'] == subnet_id
+                   for p in cloud.ports.values()):
+                raise exceptions.ConflictException(message=f'subnet {subnet_id} in use')
+            cloud.subnets.pop(subnet_id, None)
+
+    # ---- port ----
+    def ports(self, **query):
+        return self._list(self._cloud.ports, query, 'ports')
+
+    def get_port(self, port):
+        self._call('get_port')
+        return self._cloud.ports[_rid(port)]
+
+    def _new_port(self, attrs):
+        cloud = self._cloud
+        network_id = attrs['network_id']
+        fixed_ips = []
+        for fixed in attrs.get('fixed_ips') or [{}]:
+            subnet_id = fixed.get('subnet_id')
+            if subnet_id is None:
+                subnet_id = next(s.id for s in cloud.subnets.values()
+                                 if s.network_id == network_id)
+            subnet = cloud.subnets[subnet_id]
+            ip = cloud.allocate_ip(subnet, fixed.get('ip_address'))
+            fixed_ips.append({'subnet_id': subnet_id, 'ip_address': ip})
+        port = Resource(id=self._cloud.new_id(), name=attrs.get('name', ''), network_id=network_id,
+                        project_id=self._conn.project_id, fixed_ips=fixed_ips,
+                        device_id=attrs.get('device_id', ''),
+                        device_owner=attrs.get('device_owner', ''),
+                        security_group_ids=attrs.get('security_group_ids', []))
+        cloud.ports[port.id] = port
+        return port
+
+    def create_port(self, **attrs):
+        self._call('create_port')
+        with self._cloud.lock:
+            return self._new_port(attrs)
+
+    def create_ports(self, data):
+        self._call('create_ports')
+        with self._cloud.lock:
+            # 批量创建是原子的: 任何一个失败则全部回滚
+            created = []
+            try:
+                for attrs in data:
+                    created.append(self._new_port(attrs))
+            except exceptions.SDKException:
+                for port in created:
+                    self._cloud.ports.pop(port.id, None)
+                raise
+            return iter(created)
+
+    def update_port(self, port, **attrs):
+        self._call('update_port')
+        with self._cloud.lock:
+            found = self._cloud.ports[_rid(port)]
+            found.__dict__.update(attrs)
+            return found
+
+    def delete_port(self, port, ignore_missing=True):
+        self._call('delete_port')
+        with self._cloud.lock:
+            found = self._cloud.ports.get(_rid(port))
+            if found is None:
+                return None
+            if found.device_id:
+                raise exceptions.ConflictException(message=f'port {found.id} in use')
+            self._cloud._release_port(found.id)
+
+    # ---- router ----
+    def routers(self, **query):
+        return self._list(self._cloud.routers, query, 'routers')
+
+    def find_router(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_router')
+        return self._cloud._find(self._cloud.routers, name_or_id, **query)
+
+    def create_router(self, **attrs):
+        self._call('create_router')
+        router = Resource(**{'id': self._cloud.new_id(), 'project_id': self._conn.project_id,
+                             'external_gateway_info': None, **attrs})
+        cloud = self._cloud
+        with cloud.lock:
+            cloud.routers[router.id] = router
+            gateway = router.external_gateway_info
+            if gateway:
+                self._new_port({'network_id': gateway['network_id'], 'device_id': router.id,
+                                'device_owner': 'network:router_gateway'})
+        return router
+
+    def delete_router(self, router, ignore_missing=True):
+        self._call('delete_router')
+        cloud = self._cloud
+        with cloud.lock:
+            router_id = _rid(router)
+            if any(p.device_id == router_id and p.device_owner == 'network:router_interface'
+                   for p in cloud.ports.values()):
+                raise exceptions.ConflictException(message=f'router {router_id} in use')
+            for port_id in [p.id for p in cloud.ports.values() if p.device_id == router_id]:
+                cloud._release_port(port_id)
+            cloud.routers.pop(router_id, None)
+
+    def add_interface_to_router(self, router, subnet_id=None, port_id=None):
+        self._call('add_interface_to_router')
+        cloud = self._cloud
+        with cloud.lock:
+            router_id = _rid(router)
+            if subnet_id is not None:
+                subnet = cloud.subnets[subnet_id]
+                if subnet.gateway_ip is None:
+                    raise exceptions.BadRequestException(
+                        message=f'Subnet {subnet_id} does not have a gateway IP')
+                if any(p.device_id == router_id and p.fixed_ips[0]['subnet_id'] == subnet_id
+                       for p in cloud.ports.values()):
+                    raise exceptions.BadRequestException(
+                        message=f'Router already has a port on subnet {subnet_id}')
+                port = self._new_port({'network_id': subnet.network_id, 'device_id': router_id,
+                                'device_owner': 'network:router_interface',
+                                'fixed_ips': [{'subnet_id': subnet_id,
+                                               'ip_address': subnet.gateway_ip}]})
+            else:
+                port = cloud.ports[port_id]
+                port.device_id = router_id
+                port.device_owner = 'network:router_interface'
+        return {'id': router_id, 'port_id': port.id, 'subnet_id': port.fixed_ips[0]['subnet_id']}
+
+    def remove_interface_from_router(self, router, subnet_id=None, port_id=None):
+        self._call('remove_interface_from_router')
+        cloud = self._cloud
+        with cloud.lock:
+            router_id = _rid(router)
+            for port in list(cloud.ports.values()):
+                if port.device_id != router_id:
+                    continue
+                if port.id == port_id or (subnet_id is not None and
+                                          port.fixed_ips[0]['subnet_id'] == subnet_id):
+                    cloud._release_port(port.id)
+        return {'id': router_id}
+
+    # ---- floating ip ----
+    def ips(self, **query):
+        return self._list(self._cloud.fips, query, 'ips')
+
+    def create_ip(self, **attrs):
+        self._call('create_ip')
+        cloud = self._cloud
+        with cloud.lock:
+            fip = Resource(**{'id': self._cloud.new_id(), 'project_id': self._conn.project_id,
+                              'floating_ip_address': str(next(cloud._fip_pool)),
+                              'fixed_ip_address': None, 'status': 'DOWN', 'port_id': None,
+                              **attrs})
+            if fip.port_id is not None:
+                fip.fixed_ip_address = cloud.ports[fip.port_id].fixed_ips[0]['ip_address']
+                fip.status = 'ACTIVE'
+                cloud._bind_floating(fip)
+            cloud.fips[fip.id] = fip
+        return fip
+
+    def update_ip(self, floating_ip, **attrs):
+        self._call('update_ip')
+        cloud = self._cloud
+        with cloud.lock:
+            fip = cloud.fips[_rid(floating_ip)]
+            cloud._unbind_floating(fip)
+            fip.__dict__.update(attrs)
+            if fip.port_id is not None:
+                fip.fixed_ip_address = cloud.ports[fip.port_id].fixed_ips[0]['ip_address']
+                fip.status = 'ACTIVE'
+                cloud._bind_floating(fip)
+            else:
+                fip.fixed_ip_address = None
+                fip.status = 'DOWN'
+            return fip
+
+    def delete_ip(self, floating_ip, ignore_missing=True, if_revision=None):
+        self._call('delete_ip')
+        with self._cloud.lock:
+            fip = self._cloud.fips.pop(_rid(floating_ip), None)
+            if fip is not None:
+                self._cloud._unbind_floating(fip)
+
+    # ---- security group ----
+    def security_groups(self, **query):
+        return self._list(self._cloud.secgroups, query, 'security_groups')
+
+    def find_security_group(self, name_or_id, ignore_missing=True, **query):
+        self._call('find_security_group')
+        return self._cloud._find(self._cloud.secgroups, name_or_id, **query)
+
+    def create_security_group(self, **attrs):
+        self._call('create_security_group')
+        group = Resource(id=self._cloud.new_id(), project_id=self._conn.project_id, **attrs)
+        with self._cloud.lock:
+            self._cloud.secgroups[group.id] = group
+        return group
+
+    def delete_security_group(self, group, ignore_missing=True):
+        self._call('delete_security_group')
+        with self._cloud.lock:
+            self._cloud.secgroups.pop(_rid(group), None)
+
+    def _new_rule(self, attrs):
+        rule = Resource(id=self._cloud.new_id(), project_id=self._conn.project_id, **attrs)
+        self._cloud.rules[rule.id] = rule
+        return rule
+
+    def create_security_group_rule(self, **attrs):
+        self._call('create_security_group_rule')
+        with self._cloud.lock:
+            return self._new_rule(attrs)
+
+    def create_security_group_rules(self, data):
+        self._call('create_security_group_rules')
+        with self._cloud.lock:
+            return iter([self._new_rule(attrs) for attrs in data])
+
+    def security_group_rules(self, **query):
+        return self._list(self._cloud.rules, query, 'security_group_rules')
+
+    def wait_for_delete(self, res, interval=2, wait=120, callback=None):
+        return res
+
+
+def measure(func, *args, **kwargs):
+    """运行 func 并返回 (耗时, 峰值内存字节数, 返回值)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak, result
@@ -0,0 +1,190 @@
+"""
+离线基准测试: 在模拟的 OpenStack 后端上运行 up/down, 统计耗时、各接口调用次数和峰值内存
+
+python bench/run_bench.py                       运行 10/100/500 台虚拟机的配置并打印结果
+python bench/run_bench.py --save                结果保存为基准文件 bench/baseline.json
+python bench/run_bench.py --check               与基准文件对比, 有退化、任务失败或 down 后有资源残留时返回非零退出码
+"""
+import io
+import os
+import sys
+import json
+import argparse
+import tempfile
+import contextlib
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+# os_compose 导入时读取连接信息, 离线运行时填入占位值
+for key in ('OS_AUTH_URL', 'OS_PROJECT_NAME', 'OS_PROJECT_ID', 'OS_USERNAME',
+            'OS_USER_DOMAIN_NAME', 'OS_PASSWORD'):
+    os.environ.setdefault(key, 'bench')
+
+from fake_openstack import FakeCloud, measure  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+IMAGES = ['bench-centos7', 'bench-ubuntu20.04', 'bench-windows2012']
+FLAVORS = ['2m4g80', '4m8g80']
+
+
+def generate_config(path, count, per_subnet=50, float_every=5):
+    """生成 count 台虚拟机的配置文件, 每个 /24 网段 per_subnet 台, 每 float_every 台绑定一个浮动ip"""
+    vms = []
+    for index in range(count):
+        subnet, host = divmod(index, per_subnet)
+        ip = f'10.{subnet // 256}.{subnet % 256}.{host + 10}'
+        vm = {
+            'name': f'vm-{index}',
+            'image': IMAGES[index % len(IMAGES)],
+            'flavor': FLAVORS[index % len(FLAVORS)],
+            'ip_address': [f'{ip}/24'],
+        }
+        if index % float_every == 0:
+            vm['float_ip'] = ip
+        vms.append(vm)
+    config = {'project': {'name': f'bench-{count}', 'description': 'benchmark', 'vm': vms}}
+    with open(path, 'w', encoding='utf8') as fconfig:
+        yaml.safe_dump(config, fconfig, allow_unicode=True)
+
+
+def leftovers(cloud) -> dict:
+    """管理员项目之外仍然存在的资源数量, 按资源类型"""
+    admin_id = cloud.provider.project_id
+    left = {'projects': sum(project.id != admin_id for project in cloud.projects.values())}
+    for table in ('servers', 'ports', 'fips', 'secgroups', 'routers', 'subnets', 'networks'):
+        left[table] = sum(res.project_id != admin_id for res in getattr(cloud, table).values())
+    return {table: count for table, count in left.items() if count}
+
+
+def run_case(count, args, workdir):
+    """对一个规模运行 up 和 down, 返回 (各阶段的统计结果, 正确性问题列表)
+
+    up 中有任务失败、虚拟机没有全部 ACTIVE, 或 down 后项目中还有资源残留, 都记为问题
+    """
+    cloud = FakeCloud(latency=args.latency, boot_time=args.boot_time,
+                      error_rate={endpoint: args.error_rate for endpoint in args.error_endpoints},
+                      seed=args.seed, images=IMAGES, flavors=FLAVORS).install()
+    try:
+        import os_compose
+        from libs import limiter
+        from libs import events
+        # 管理员连接在进程内缓存, 每个规模换了新的模拟后端, 需要重新连接
+        os_compose._admin.clear()
+        # 和命令行一样经过统一的调度器, 注入的错误会被重试
+        limiter.start()
+        config_file = os.path.join(workdir, f'bench-{count}.yaml')
+        generate_config(config_file, count)
+        result = {}
+        problems = []
+        failed = events.subscribe(lambda event: event['event'] == 'failed' and problems.append(
+            f"bench-{count} up: {event['kind']} {event['name']} 失败: {event.get('error', '')}"))
+        try:
+            for phase, func in (('up', lambda: os_compose.up(config_file, args.parallel)),
+                                ('down', lambda: os_compose.down(config_file))):
+                cloud.reset_calls()
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        elapsed, peak, _ = measure(func)
+                except Exception as err:
+                    problems.append(f'bench-{count} {phase} 出错: {err}')
+                    continue
+                result[phase] = {
+                    'wall': round(elapsed, 3),
+                    'peak_kb': peak // 1024,
+                    'calls': dict(sorted(cloud.calls.items())),
+                }
+                if phase == 'up':
+                    active = sum(server.status == 'ACTIVE' for server in cloud.servers.values())
+                    if active != count:
+                        problems.append(f'bench-{count} up: {active}/{count} 台虚拟机 ACTIVE')
+        finally:
+            events.unsubscribe(failed)
+        left = leftovers(cloud)
+        if left:
+            problems.append(f'bench-{count} down 后仍有资源未删除: {left}')
+        return result, problems
+    finally:
+        limiter.stop()
+        cloud.uninstall()
+
+
+def print_result(count, result) -> None:
+    for phase, stats in result.items():
+        total = sum(stats['calls'].values())
+        print(f"|{count:>4} 台\t|\t{phase:<4}\t|\t{stats['wall']:>8.3f}s\t|\t{total:>6} 次调用\t|\t"
+              f"{stats['peak_kb']:>8} KB|")
+        for endpoint, calls in stats['calls'].items():
+            print(f'\t{endpoint:<40}{calls:>6}')
+
+
+def check(results, baseline, tolerance) -> list:
+    """与基准对比, 返回退化项列表
+
+    轮询类接口的调用次数随时间略有波动, 调用次数超过基准 10% 加 2 次算退化;
+    耗时和峰值内存超过基准的 (1 + tolerance) 倍算退化
+    """
+    problems = []
+    for count, result in results.items():
+        base_case = baseline.get(count)
+        if base_case is None:
+            continue
+        for phase, stats in result.items():
+            base = base_case.get(phase)
+            if base is None:
+                continue
+            for endpoint, calls in stats['calls'].items():
+                if calls > base['calls'].get(endpoint, 0) * 1.1 + 2:
+                    problems.append(f"{count} 台 {phase}: {endpoint} 调用 {base['calls'].get(endpoint, 0)} -> {calls}")
+            for key in ('wall', 'peak_kb'):
+                if stats[key] > base[key] * (1 + tolerance):
+                    problems.append(f'{count} 台 {phase}: {key} {base[key]} -> {stats[key]}')
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='os_compose 离线基准测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500], help='虚拟机数量')
+    parser.add_argument('--latency', type=float, default=0.002, help='每次调用的模拟延迟(秒)')
+    parser.add_argument('--boot-time', type=float, default=0.5, help='虚拟机启动时间(秒)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='注入 503 错误的概率')
+    parser.add_argument('--error-endpoints', nargs='+', default=['compute.delete_server', 'network.delete_subnet'],
+                        help='注入错误的接口, 如 compute.delete_server')
+    parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+    parser.add_argument('-p', '--parallel', type=int, default=4, help='up 同时执行的任务数量')
+    parser.add_argument('--save', nargs='?', const=DEFAULT_BASELINE, default=None, help='保存为基准文件')
+    parser.add_argument('--check', nargs='?', const=DEFAULT_BASELINE, default=None, help='与基准文件对比')
+    parser.add_argument('--tolerance', type=float, default=1.0, help='耗时和内存允许超出基准的比例')
+    args = parser.parse_args()
+
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for count in args.sizes:
+            results[str(count)], problems = run_case(count, args, workdir)
+            print_result(count, results[str(count)])
+            for problem in problems:
+                print(f'[ERROR] {problem}')
+            failures += problems
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf8') as fbase:
+            json.dump(results, fbase, ensure_ascii=False, indent=1)
+        print(f'基准已保存到 {args.save}')
+    if args.check:
+        with open(args.check, 'r', encoding='utf8') as fbase:
+            problems = check(results, json.load(fbase), args.tolerance)
+        for problem in problems:
+            print(f'[REGRESSION] {problem}')
+        # 结果不正确时, 无论耗时和调用次数如何都算失败
+        if problems or failures:
+            return 1
+        print('与基准相比没有退化')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,29 +1,77 @@
 """
 解析YAML配置文件, 创建config对象
 """
+import string
 import yaml
 from libs.vm import VM
+from libs.ipam import allocate_ips
+from libs.userdata import build_user_data
 
 class Config:
-    def __init__(self, filename) -> None:
-        """解析YAML配置文件"""
+    def __init__(self, filename, variables=None) -> None:
+        """解析YAML配置文件, variables 不为空时先替换文件中的 ${变量}"""
         try:
             with open(filename, "r", encoding="utf8") as yaml_config:
-                self.project = yaml.safe_load(yaml_config)['project']
+                text = yaml_config.read()
+            if variables:
+                text = string.Template(text).safe_substitute(variables)
+            self.project = yaml.safe_load(text)['project']
             self.vm_cfgs = self.project['vm']
             # 从配置文件中读取网络信息
             #self.network_cfgs = self.project['nets']
             self.project_name = self.project['name']
             self.project_description = self.project['description']
+            # 预热池: [{image, flavor, size}], 项目内按镜像和配额保留的空闲虚拟机
+            self.warm_pool = self.project.get('warm_pool') or []
         except KeyError as err:
             print(f'WARNING {err} is missing!')
 
 
+    @staticmethod
+    def replica_count(vm_cfg) -> int:
+        """count/replicas 指定的副本数量, 可以写成只有数字的字符串 (如 "2");
+        不是正整数时 (包括 2.7、true 这样会被 int() 悄悄转换的值) 抛出 ValueError"""
+        count = vm_cfg.get('count', vm_cfg.get('replicas', 1))
+        if isinstance(count, int) and not isinstance(count, bool):
+            value = count
+        elif isinstance(count, str) and count.isascii() and count.isdigit():
+            value = int(count)
+        else:
+            value = 0
+        if value < 1:
+            raise ValueError(f"{vm_cfg.get('name')} 的副本数量 {count} 不是正整数")
+        return value
+
+    @staticmethod
+    def replica_name(name, index, count) -> str:
+        """副本的名字: 名字中有 {index} 时按序号格式化 (如 target-{index:03}), 否则多副本时加上 -序号;
+        名字中的其他 {...} 无法格式化时抛出 ValueError"""
+        name = str(name)
+        if '{' in name:
+            try:
+                return name.format(index=index)
+            except (KeyError, IndexError, AttributeError, ValueError) as err:
+                raise ValueError(f'虚拟机名 {name} 格式错误, 只能使用 {{index}}: {err!r}') from None
+        return name if count == 1 else f'{name}-{index}'
+
     def parse_vm(self) -> list[VM]:
-        """根据配置文件, 创建VM对象"""
+        """根据配置文件, 创建VM对象
+
+        count/replicas 指定副本数量; ip_address 写成网段地址的网卡自动分配ip,
+        ip冲突、虚拟机重名、脚本编码后过大等错误在这里抛出 ValueError, 不会等到调用 OpenStack 时才发现
+        """
         vm_list = []
         for vm_cfg in self.vm_cfgs:
-            vm = VM(vm_cfg)
-            vm_list.append(vm)
+            count = self.replica_count(vm_cfg)
+            for index in range(1, count + 1):
+                vm = VM(dict(vm_cfg, name=self.replica_name(vm_cfg['name'], index, count)))
+                vm_list.append(vm)
+        names = set()
+        for vm in vm_list:
+            if vm.name in names:
+                raise ValueError(f'虚拟机名重复: {vm.name}')
+            names.add(vm.name)
+        allocate_ips(vm_list)
+        build_user_data(vm_list)
         return vm_list
    
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""
+结构化事件流: 资源创建、就绪、失败、删除时发出事件, 以 JSON lines 写到标准输出、文件或 socket
+
+emit() 在没有订阅者时不做任何事; subscribe() 注册回调, 每个事件是一个 dict:
+{"ts": 时间戳, "event": created/ready/failed/deleted/started/finished, "kind": 资源类型, "name": 名字, ...}
+"""
+import sys
+import json
+import time
+import queue
+import socket
+import threading
+
+_listeners = []
+_lock = threading.Lock()
+
+
+def subscribe(listener):
+    """注册回调, 之后发出的每个事件都会调用 listener(event), 返回 listener"""
+    with _lock:
+        _listeners.append(listener)
+    return listener
+
+
+def unsubscribe(listener) -> None:
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def emit(event, kind, name='', **fields) -> None:
+    """发出一个事件, 值为 None 的字段省略"""
+    with _lock:
+        listeners = list(_listeners)
+    if not listeners:
+        return
+    record = {'ts': round(time.time(), 3), 'event': event, 'kind': kind, 'name': name}
+    record.update((key, value) for key, value in fields.items() if value is not None)
+    for listener in listeners:
+        listener(record)
+
+
+class JsonLinesSink:
+    """把事件逐行写成 JSON, 可以在多个线程之间共享
+
+    target 为 '-' 或空时写到标准输出, tcp://host:port 或 unix:///path 时连接 socket, 否则追加写入文件
+    """
+    def __init__(self, target='-') -> None:
+        self.target = target or '-'
+        self.to_stdout = self.target == '-'
+        self._lock = threading.Lock()
+        self._socket = None
+        if self.to_stdout:
+            self._stream = sys.stdout
+        elif self.target.startswith('tcp://'):
+            host, _, port = self.target[len('tcp://'):].rpartition(':')
+            self._socket = socket.create_connection((host, int(port)))
+            self._stream = self._socket.makefile('w', encoding='utf8')
+        elif self.target.startswith('unix://'):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.target[len('unix://'):])
+            self._stream = self._socket.makefile('w', encoding='utf8')
+        else:
+            self._stream = open(self.target, 'a', encoding='utf8')
+
+    def __call__(self, event) -> None:
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            self._stream.write(line + '\n')
+            # 每个事件立即送出, 下游不必等到执行结束
+            self._stream.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self.to_stdout:
+                self._stream.close()
+            if self._socket is not None:
+                self._socket.close()
+
+
+def stream(func, *args, **kwargs):
+    """在后台线程中执行 func, 以生成器的方式逐个返回执行期间发出的事件
+
+    func 结束后生成器结束, func 抛出的异常在最后一个事件之后重新抛出;
+    同一进程中同时执行的其他操作发出的事件也会收到, 可以按 project 字段区分
+    """
+    events = queue.Queue()
+    done = object()
+    errors = []
+
+    def run():
+        try:
+            func(*args, **kwargs)
+        except BaseException as err:
+            errors.append(err)
+        finally:
+            events.put(done)
+
+    listener = subscribe(events.put)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            event = events.get()
+            if event is done:
+                break
+            yield event
+    finally:
+        unsubscribe(listener)
+    thread.join()
+    if errors:
+        raise errors[0]
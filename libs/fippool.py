@@ -0,0 +1,65 @@
+"""
+项目的浮动ip池, 提前批量分配, 虚拟机启动后直接取用
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from libs import trace
+
+
+class FloatingIPPool:
+    """预先为项目准备好需要的浮动ip
+
+    fill() 先用一次按项目过滤的列表查询复用项目中未绑定的浮动ip, 不足的部分并发分配;
+    acquire() 取出一个浮动ip, 池空时再临时分配; bind() 一次请求绑定到端口;
+    release() 删除本次分配但没有用到的浮动ip。可以在多个线程之间共享。
+    """
+    def __init__(self, connection, network_id, parallel=4) -> None:
+        self.connection = connection
+        self.network_id = network_id
+        self.parallel = parallel
+        self._lock = threading.Lock()
+        self._free = []
+        self._allocated = set()
+
+    def _allocate(self):
+        floating_ip = self.connection.network.create_ip(floating_network_id=self.network_id)
+        with self._lock:
+            self._allocated.add(floating_ip.id)
+        return floating_ip
+
+    def fill(self, count) -> None:
+        """准备 count 个空闲浮动ip"""
+        project_id = self.connection.session.get_project_id()
+        reused = [fip for fip in self.connection.network.ips(project_id=project_id,
+                                                             floating_network_id=self.network_id)
+                  if not fip.port_id]
+        with self._lock:
+            known = {fip.id for fip in self._free}
+            self._free.extend(fip for fip in reused if fip.id not in known)
+            missing = count - len(self._free)
+        if missing > 0:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                created = list(executor.map(trace.bind(lambda _: self._allocate()), range(missing)))
+            with self._lock:
+                self._free.extend(created)
+        print(f'正在准备浮动ip {count} 个...OK (复用 {min(len(reused), count)} 个)')
+
+    def acquire(self):
+        """取出一个空闲浮动ip, 池空时临时分配"""
+        with self._lock:
+            if self._free:
+                return self._free.pop(0)
+        return self._allocate()
+
+    def bind(self, floating_ip, port_id):
+        """把浮动ip绑定到端口, 返回更新后的浮动ip"""
+        return self.connection.network.update_ip(floating_ip, port_id=port_id)
+
+    def release(self) -> None:
+        """删除本次分配但没有用到的浮动ip, 复用的浮动ip保持原样"""
+        with self._lock:
+            unused = [fip for fip in self._free if fip.id in self._allocated]
+            self._free = [fip for fip in self._free if fip.id not in self._allocated]
+        for fip in unused:
+            self.connection.network.delete_ip(fip, ignore_missing=True)
@@ -0,0 +1,97 @@
+"""
+离线分配虚拟机ip, 在调用 OpenStack 之前发现ip冲突
+"""
+import netaddr
+
+
+def gateway_ip(cidr, routed):
+    """与 create_subnet 的约定一致: 需要连接路由的网段网关为网段内第254个地址, 否则不设网关"""
+    return str(netaddr.IPAddress(netaddr.IPNetwork(cidr).first + 254)) if routed else ''
+
+
+def is_auto(vm_ip) -> bool:
+    """ip_address 中写网段地址 (如 172.26.10.0/24) 表示由分配器自动分配"""
+    return vm_ip.prefixlen < 31 and vm_ip.ip == vm_ip.network
+
+
+class SubnetAllocator:
+    """一个网段的地址分配器, 地址池与 create_subnet 相同 (网段地址+2 到 广播地址-2)
+
+    只记录整数游标和已占用的地址, 不展开整个地址池, /16 这样的大网段也能快速分配
+    """
+    def __init__(self, cidr, gateway='') -> None:
+        self.cidr = netaddr.IPNetwork(cidr)
+        self.start = self.cidr.first + 2
+        self.end = self.cidr.last - 2
+        self.gateway = int(netaddr.IPAddress(gateway)) if gateway else None
+        self._cursor = self.start
+        # 指定的ip -> 虚拟机名
+        self._owners = {}
+        # 自动分配时跳过的地址: 网关、指定的ip, 以及 DHCP 端口一般占用的地址池第一个地址
+        self._reserved = {self.start}
+        if self.gateway is not None:
+            self._reserved.add(self.gateway)
+
+    def pin(self, ip, owner) -> None:
+        """登记配置中指定的ip, 与网段地址、广播地址、网关或其他虚拟机冲突时抛出 ValueError"""
+        value = int(ip)
+        if value in (self.cidr.first, self.cidr.last):
+            raise ValueError(f'{owner} 的ip {ip} 是 {self.cidr} 的网段地址或广播地址')
+        if value == self.gateway:
+            raise ValueError(f'{owner} 的ip {ip} 与 {self.cidr} 的网关冲突')
+        if value in self._owners:
+            raise ValueError(f'{owner} 的ip {ip} 与 {self._owners[value]} 冲突')
+        self._owners[value] = owner
+        self._reserved.add(value)
+
+    def allocate(self, owner):
+        """按顺序分配下一个空闲地址, 地址池用完时抛出 ValueError"""
+        while self._cursor in self._reserved:
+            self._cursor += 1
+        if self._cursor > self.end:
+            raise ValueError(f'{self.cidr} 的地址池已用完, 无法为 {owner} 分配ip')
+        value = self._cursor
+        self._cursor += 1
+        self._owners[value] = owner
+        return netaddr.IPAddress(value)
+
+
+def allocate_ips(vm_list) -> None:
+    """检查指定的ip是否冲突, 并为写成网段地址的网卡分配ip
+
+    先登记所有指定的ip, 再按配置顺序自动分配, 同一份配置每次分配的结果相同;
+    float_ip 写成网段地址时绑定到该网卡分配到的ip
+    """
+    # 需要绑定浮动ip的网段会连接路由并设置网关
+    routed = set()
+    for vm in vm_list:
+        if vm.have_float_ip != 'yes':
+            continue
+        float_ip = netaddr.IPNetwork(vm.float_ip_bind).ip
+        nic = next((vm_ip for vm_ip in vm.ip_address
+                    if vm_ip.ip == float_ip or (is_auto(vm_ip) and vm_ip.network == float_ip)), None)
+        if nic is None:
+            raise ValueError(f'{vm.name} 的浮动ip绑定地址 {vm.float_ip_bind} 不在 ip_address 中')
+        vm.float_ip_bind = str(float_ip)
+        routed.add(str(nic.cidr))
+
+    allocators = {}
+
+    def allocator(vm_ip):
+        cidr = str(vm_ip.cidr)
+        if cidr not in allocators:
+            allocators[cidr] = SubnetAllocator(cidr, gateway_ip(cidr, cidr in routed))
+        return allocators[cidr]
+
+    for vm in vm_list:
+        for vm_ip in vm.ip_address:
+            if not is_auto(vm_ip):
+                allocator(vm_ip).pin(vm_ip.ip, vm.name)
+    for vm in vm_list:
+        for index, vm_ip in enumerate(vm.ip_address):
+            if not is_auto(vm_ip):
+                continue
+            ip = allocator(vm_ip).allocate(vm.name)
+            if vm.have_float_ip == 'yes' and vm.float_ip_bind == str(vm_ip.network):
+                vm.float_ip_bind = str(ip)
+            vm.ip_address[index] = netaddr.IPNetwork(f'{ip}/{vm_ip.prefixlen}')
@@ -0,0 +1,220 @@
+"""
+OpenStack API 调用的统一调度: 限制并发和速率, 可重试的错误退避后重试
+
+start() 开启调度后, 用 wrap() 包装的连接上的每次 SDK 调用都经过同一个 ApiLimiter:
+整个进程的并发上限、每个服务自适应的并发上限、令牌桶限速, 以及限流、过载和冲突错误的退避重试
+"""
+import time
+import random
+import threading
+
+from libs.proxy import SERVICES, ProxyConnection, drain
+
+# 各服务默认的并发上限, 不超过整个进程的上限
+SERVICE_LIMITS = {'compute': 16, 'network': 16, 'identity': 8, 'image': 4}
+# 服务端过载或限流, 下调并发上限并重试
+THROTTLE_STATUS = (429, 502, 503, 504)
+# 其中只有这些表示请求确定没有被处理; 502/504 是网关报错, 后端可能已经执行了请求
+REJECTED_STATUS = (429, 503)
+
+_limiter = None
+
+
+def parse_service_limits(items) -> dict:
+    """把命令行中的 compute=8 network=16 解析为 {服务: 并发上限}"""
+    limits = {}
+    for item in items or []:
+        service, _, value = item.partition('=')
+        if service not in SERVICES or not value.isdigit():
+            raise ValueError(f'无效的服务并发上限: {item}, 格式为 <{"|".join(SERVICES)}>=N')
+        limits[service] = int(value)
+    return limits
+
+
+def retryable(name, err) -> bool:
+    """判断失败的调用是否可以重试
+
+    429/503 表示请求没有被处理, 都可以重试; 502/504 时后端可能已经执行了请求, 重试 create_*
+    可能创建出重复的虚拟机或浮动ip, 所以只重试查询、更新和删除类调用;
+    409 只对更新类调用重试 (如路由正忙时连接子网),
+    create_* 的 409 表示资源已存在或地址用完, delete_* 的 409 表示资源仍在使用, 由调用方处理
+    """
+    from openstack import exceptions
+    status = getattr(err, 'status_code', None)
+    if status in REJECTED_STATUS:
+        return True
+    if status in THROTTLE_STATUS:
+        return not name.startswith('create_')
+    if status == 409 or isinstance(err, exceptions.ConflictException):
+        return not name.startswith(('create_', 'delete_'))
+    return False
+
+
+def _retry_after(err):
+    """服务端在 Retry-After 中给出的等待秒数"""
+    headers = getattr(getattr(err, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """每秒补充 rate 个令牌, 最多积累 burst 个, 每次调用消耗一个"""
+    def __init__(self, rate, burst=None) -> None:
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimit:
+    """一个服务的并发上限, 按延迟和错误自适应调整 (AIMD)
+
+    被限流时上限减半; 延迟明显高于该接口观察到的最低延迟时小幅下调;
+    其他成功的调用每轮 (约 limit 次调用) 把上限加一, 直到 maximum
+    """
+    def __init__(self, maximum, minimum=1) -> None:
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.limit = float(self.maximum)
+        self.active = 0
+        self._cond = threading.Condition()
+        # 接口 -> 观察到的最低延迟
+        self._baseline = {}
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, name, latency=None, throttled=False) -> None:
+        with self._cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif latency is not None:
+                baseline = min(self._baseline.get(name, latency), latency)
+                self._baseline[name] = baseline
+                if latency > 3 * baseline and latency > 0.05:
+                    self.limit = max(self.minimum, self.limit * 0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class ApiLimiter:
+    """进程内所有 API 调用的调度器, 可以在多个线程之间共享
+
+    同时进行的调用不超过 max_calls 个, 每个服务另有自适应的并发上限;
+    rate 大于 0 时每秒发出的调用不超过 rate 个; 可重试的错误按指数退避加随机抖动重试 retries 次
+    """
+    def __init__(self, max_calls=32, rate=0, limits=None, retries=5, backoff=0.5, max_backoff=30) -> None:
+        self.max_calls = max_calls
+        self._slots = threading.BoundedSemaphore(max(max_calls, 1))
+        self._bucket = TokenBucket(rate) if rate > 0 else None
+        limits = dict(SERVICE_LIMITS, **(limits or {}))
+        self.services = {service: AdaptiveLimit(min(limit, max_calls)) for service, limit in limits.items()}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.retried = 0
+        self.gave_up = 0
+
+    def _attempt(self, service, name, func, args, kwargs):
+        from openstack import exceptions
+        limit = self.services[service]
+        if self._bucket is not None:
+            self._bucket.take()
+        limit.acquire()
+        with self._slots:
+            begin = time.monotonic()
+            try:
+                result = drain(func(*args, **kwargs))
+            except exceptions.HttpException as err:
+                limit.release(name, throttled=getattr(err, 'status_code', None) in THROTTLE_STATUS)
+                raise
+            except BaseException:
+                limit.release(name)
+                raise
+            limit.release(name, time.monotonic() - begin)
+            return result
+
+    def call(self, service, name, func, /, *args, **kwargs):
+        from openstack import exceptions
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(service, name, func, args, kwargs)
+            except exceptions.HttpException as err:
+                if not retryable(name, err):
+                    raise
+                if attempt >= self.retries:
+                    with self._lock:
+                        self.gave_up += 1
+                    raise
+                # 指数退避加全随机抖动, 服务端给出 Retry-After 时至少等待这么久
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                delay = max(delay, _retry_after(err) or 0)
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                time.sleep(delay)
+
+    def summary(self) -> None:
+        """有重试时打印重试次数和各服务最终的并发上限"""
+        if not self.retried:
+            return
+        limits = ', '.join(f'{service}={int(limit.limit)}' for service, limit in self.services.items())
+        print(f'API 重试 {self.retried} 次, 放弃 {self.gave_up} 次, 并发上限: {limits}')
+
+
+def start(max_calls=32, **kwargs) -> ApiLimiter:
+    """开启调度, 之后新建的连接都会被包装"""
+    global _limiter
+    _limiter = ApiLimiter(max_calls, **kwargs)
+    return _limiter
+
+
+def stop():
+    """停止调度, 返回调度器"""
+    global _limiter
+    limiter, _limiter = _limiter, None
+    return limiter
+
+
+def current():
+    """当前的调度器, 未开启时为 None"""
+    return _limiter
+
+
+def wrap(connection):
+    """开启调度时返回包装后的连接, 否则原样返回"""
+    if _limiter is None or isinstance(connection, LimitedConnection):
+        return connection
+    return LimitedConnection(connection, _limiter)
+
+
+class LimitedConnection(ProxyConnection):
+    """转发对连接的访问, 服务代理的每次调用都经过调度器"""
+    def __init__(self, connection, limiter) -> None:
+        super().__init__(connection)
+        self._limiter = limiter
+
+    def wrap_call(self, service, name, func):
+        return lambda *args, **kwargs: self._limiter.call(service, name, func, *args, **kwargs)
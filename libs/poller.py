@@ -0,0 +1,129 @@
+"""
+批量轮询虚拟机状态, 每轮只发起一次 servers() 列表请求
+"""
+import re
+import time
+import threading
+
+from libs import trace
+
+
+class ServerPoller:
+    """等待一组虚拟机进入 ACTIVE 或 ERROR 状态
+
+    通过 watch() 登记的虚拟机由一个后台线程统一轮询, 每轮用一次 servers(details=True)
+    请求获取项目内全部待定虚拟机的状态, 多个线程可以分别用 wait_for() 等待各自的虚拟机。
+    轮询间隔在没有状态变化时逐渐变长, 有变化时恢复最小值; 每台虚拟机从登记时开始计算超时时间。
+    """
+    ready_status = 'ACTIVE'
+    failed_status = 'ERROR'
+
+    def __init__(self, connection, timeout=600, min_interval=1, max_interval=10, backoff=1.5) -> None:
+        self.connection = connection
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._done = {}
+        # 虚拟机ID -> 超时时刻
+        self._deadlines = {}
+        self._thread = None
+
+    def _list_pending(self, pending):
+        """一次请求列出待定的虚拟机, 只有一台时按名字过滤"""
+        query = {'project_id': self.connection.session.get_project_id()}
+        if len(pending) == 1:
+            query['name'] = f"^{re.escape(next(iter(pending.values())).name)}$"
+        return {server.id: server for server in self.connection.compute.servers(details=True, **query)}
+
+    def watch(self, server) -> None:
+        """登记要等待的虚拟机, 需要时启动后台轮询线程"""
+        with self._cond:
+            if server.id not in self._pending:
+                self._deadlines[server.id] = time.monotonic() + self.timeout
+            self._pending[server.id] = server
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def wait_for(self, server):
+        """阻塞直到虚拟机状态稳定, 返回最新的虚拟机对象
+
+        虚拟机进入 ERROR 时抛出 ResourceFailure, 超时抛出 ResourceTimeout;
+        轮询线程意外退出时也不会一直等待, 超过超时时间加一个轮询间隔后抛出 ResourceTimeout
+        """
+        from openstack import exceptions
+        self.watch(server)
+        deadline = time.monotonic() + self.timeout + self.max_interval
+        with self._cond:
+            while server.id not in self._done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._pending.pop(server.id, None)
+                    self._deadlines.pop(server.id, None)
+                    raise exceptions.ResourceTimeout(f'{server.name} 等待超时')
+                self._cond.wait(remaining)
+            status, latest = self._done[server.id]
+        if status == self.failed_status:
+            raise exceptions.ResourceFailure(f'{latest.name} 创建失败, 状态为 {latest.status}')
+        if status != self.ready_status:
+            raise exceptions.ResourceTimeout(f'{latest.name} 等待超时')
+        return latest
+
+    def _run(self) -> None:
+        """后台轮询, 直到没有待定的虚拟机"""
+        try:
+            with trace.phase('wait', 'poller'):
+                self._poll()
+        finally:
+            # 线程因意外错误退出时, 待定的虚拟机按超时处理, 不让 wait_for() 一直等待
+            with self._cond:
+                if self._thread is threading.current_thread():
+                    for server_id, server in self._pending.items():
+                        self._done[server_id] = ('TIMEOUT', server)
+                    self._pending.clear()
+                    self._deadlines.clear()
+                    self._thread = None
+                    self._cond.notify_all()
+
+    def _poll(self) -> None:
+        interval = self.min_interval
+        while True:
+            with self._cond:
+                pending = dict(self._pending)
+            changed = False
+            try:
+                servers = self._list_pending(pending)
+            except Exception as err:
+                # 除了 SDKException, keystoneauth 的 ConnectFailure 等网络错误也只跳过这一轮
+                print(f'[WARNING] 查询虚拟机状态失败: {err}')
+                servers = {}
+            with self._cond:
+                for server_id, server in servers.items():
+                    if server_id not in self._pending:
+                        continue
+                    if server.status in (self.ready_status, self.failed_status):
+                        del self._pending[server_id]
+                        del self._deadlines[server_id]
+                        self._done[server_id] = (server.status, server)
+                        changed = True
+                    else:
+                        self._pending[server_id] = server
+                now = time.monotonic()
+                for server_id in [server_id for server_id in self._pending if self._deadlines[server_id] <= now]:
+                    self._done[server_id] = ('TIMEOUT', self._pending.pop(server_id))
+                    del self._deadlines[server_id]
+                    changed = True
+                if changed:
+                    self._cond.notify_all()
+                if not self._pending:
+                    self._thread = None
+                    return
+                remaining = min(self._deadlines.values()) - now
+            # 有虚拟机状态变化时恢复最小间隔, 否则逐渐拉长间隔
+            if changed:
+                interval = self.min_interval
+            time.sleep(min(interval, remaining))
+            interval = min(interval * self.backoff, self.max_interval)
@@ -0,0 +1,47 @@
+"""
+包装 openstack 连接的服务代理, trace 和 limiter 共用
+"""
+import types
+
+# 会被包装的 SDK 服务代理
+SERVICES = ('compute', 'network', 'identity', 'image')
+
+
+def drain(result):
+    """列表接口返回生成器, 真正的请求在迭代时发生, 取完才能计时或释放名额"""
+    if isinstance(result, types.GeneratorType):
+        return iter(list(result))
+    return result
+
+
+class ProxyConnection:
+    """转发对连接的访问, SERVICES 中服务代理的每个公开方法都经过 wrap_call() 包装
+
+    子类实现 wrap_call(service, name, func), 返回代替 func 被调用的函数
+    """
+    def __init__(self, connection) -> None:
+        self._connection = connection
+        self._proxies = {}
+
+    def wrap_call(self, service, name, func):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        if name in SERVICES:
+            if name not in self._proxies:
+                self._proxies[name] = _ServiceProxy(name, getattr(self._connection, name), self.wrap_call)
+            return self._proxies[name]
+        return getattr(self._connection, name)
+
+
+class _ServiceProxy:
+    def __init__(self, service, proxy, wrap_call) -> None:
+        self._service = service
+        self._proxy = proxy
+        self._wrap_call = wrap_call
+
+    def __getattr__(self, name):
+        attr = getattr(self._proxy, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+        return self._wrap_call(self._service, name, attr)
@@ -0,0 +1,117 @@
+"""
+对比配置文件和项目的实际状态, 计算需要变更的资源
+"""
+
+
+class Change:
+    """一项资源变更, action 为 create/replace/delete"""
+    symbols = {'create': '+', 'replace': '~', 'delete': '-'}
+
+    def __init__(self, action, kind, name, detail='', resource=None, vm=None) -> None:
+        self.action = action
+        self.kind = kind
+        self.name = name
+        self.detail = detail
+        # 已存在的资源对象, 创建时为 None
+        self.resource = resource
+        # 对应的虚拟机配置, 删除时为 None
+        self.vm = vm
+
+    def __str__(self) -> str:
+        detail = f' ({self.detail})' if self.detail else ''
+        return f'{self.symbols[self.action]} {self.kind} {self.name}{detail}'
+
+
+class Reconciler:
+    """批量读取项目内的虚拟机、浮动ip、子网和路由接口, 与配置对比"""
+    def __init__(self, connection, resolver) -> None:
+        self.connection = connection
+        self.resolver = resolver
+        project_id = connection.session.get_project_id()
+        network = connection.network
+        self.servers = list(connection.compute.servers(details=True, project_id=project_id))
+        self.ips = list(network.ips(project_id=project_id))
+        self.subnets = {subnet.cidr: subnet for subnet in network.subnets(project_id=project_id)}
+        self.interfaces = list(network.ports(project_id=project_id, device_owner='network:router_interface'))
+
+    def _addresses(self, server):
+        """虚拟机的固定ip; Nova 在 addresses 中也列出绑定的浮动ip (OS-EXT-IPS:type 为 floating), 不参与对比"""
+        floating = {fip.floating_ip_address for fip in self.ips}
+        return {addr['addr'] for addrs in (server.addresses or {}).values() for addr in addrs
+                if addr.get('OS-EXT-IPS:type') != 'floating' and addr['addr'] not in floating}
+
+    def _server_diff(self, vm, server):
+        """返回虚拟机需要重建的原因, 不需要重建时返回空字符串"""
+        reasons = []
+        image = server.image or {}
+        if image.get('id') != self.resolver.image_id(vm.image):
+            reasons.append(f'image -> {vm.image}')
+        flavor = server.flavor or {}
+        if flavor.get('original_name', flavor.get('name')) != vm.flavor and \
+                flavor.get('id') != self.resolver.flavor_id(vm.flavor):
+            reasons.append(f'flavor -> {vm.flavor}')
+        wanted = {str(vm_ip.ip) for vm_ip in vm.ip_address}
+        actual = self._addresses(server)
+        if wanted != actual:
+            reasons.append(f"ip_address {sorted(actual)} -> {sorted(wanted)}")
+        return ', '.join(reasons)
+
+    def diff(self, vm_list) -> list:
+        """返回配置和实际状态之间的变更列表"""
+        changes = []
+        servers_by_name = {}
+        for server in self.servers:
+            servers_by_name.setdefault(server.name, []).append(server)
+        ips_by_fixed = {fip.fixed_ip_address: fip for fip in self.ips if fip.fixed_ip_address}
+        wanted_cidrs = {}
+        for vm in vm_list:
+            for vm_ip in vm.ip_address:
+                wanted_cidrs.setdefault(str(vm_ip.cidr), vm)
+
+        # 虚拟机: 同名的多余实例和配置中已删除的虚拟机都要删除
+        for name, servers in servers_by_name.items():
+            extra = servers[1:] if any(vm.name == name for vm in vm_list) else servers
+            for server in extra:
+                changes.append(Change('delete', 'server', name, resource=server))
+        for vm in vm_list:
+            servers = servers_by_name.get(vm.name)
+            if not servers:
+                changes.append(Change('create', 'server', vm.name, vm=vm))
+                continue
+            server = servers[0]
+            reason = self._server_diff(vm, server)
+            if reason:
+                changes.append(Change('replace', 'server', vm.name, reason, server, vm))
+                continue
+            # 虚拟机不变时只对比浮动ip
+            addresses = self._addresses(server)
+            bound = [fip for addr, fip in ips_by_fixed.items() if addr in addresses]
+            wanted_ip = vm.float_ip_bind if vm.have_float_ip == 'yes' else None
+            for fip in bound:
+                if fip.fixed_ip_address != wanted_ip:
+                    changes.append(Change('delete', 'floating-ip', vm.name, fip.floating_ip_address, fip, vm))
+            if wanted_ip is not None and all(fip.fixed_ip_address != wanted_ip for fip in bound):
+                changes.append(Change('create', 'floating-ip', vm.name, wanted_ip, server, vm))
+
+        # 要删除或重建的虚拟机上绑定的浮动ip一起删除
+        for change in list(changes):
+            if change.kind == 'server' and change.resource is not None:
+                for addr in self._addresses(change.resource):
+                    if addr in ips_by_fixed:
+                        fip = ips_by_fixed[addr]
+                        changes.append(Change('delete', 'floating-ip', change.name, fip.floating_ip_address, fip))
+
+        # 子网: 配置中不再使用的网段删除, 新网段随虚拟机一起创建
+        for cidr, subnet in self.subnets.items():
+            if cidr not in wanted_cidrs:
+                changes.append(Change('delete', 'subnet', cidr, resource=subnet))
+        for cidr, vm in wanted_cidrs.items():
+            if cidr not in self.subnets:
+                changes.append(Change('create', 'subnet', cidr, vm=vm))
+        return changes
+
+    def interfaces_of(self, subnets) -> list:
+        """返回连接指定子网的路由接口"""
+        subnet_ids = {subnet.id for subnet in subnets}
+        return [port for port in self.interfaces
+                if any(fixed['subnet_id'] in subnet_ids for fixed in port.fixed_ips)]
@@ -0,0 +1,107 @@
+"""
+镜像、配额和外部网络的 名字->ID 解析, 支持带过期时间的本地缓存
+"""
+import os
+import json
+import time
+import threading
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'os_compose', 'resolver.json')
+
+
+class Resolver:
+    """批量加载镜像、配额和外部网络, 之后的名字查找都在内存中完成
+
+    cache_file 不为 None 时, 查询结果会写入本地缓存文件, ttl 秒内的后续运行直接读取缓存。
+    cache_key 用来区分不同的 OpenStack 集群, 一般传入 auth_url。
+    """
+    kinds = ('images', 'flavors', 'networks')
+
+    def __init__(self, connection, cache_file=None, ttl=3600, cache_key='') -> None:
+        self.connection = connection
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.cache_key = cache_key
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._load_cache()
+
+    def _load_cache(self) -> None:
+        """读取未过期的本地缓存"""
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf8') as fcache:
+                cache = json.load(fcache)
+        except (OSError, ValueError):
+            return
+        if cache.get('key') != self.cache_key or time.time() - cache.get('time', 0) > self.ttl:
+            return
+        self._tables = {kind: cache[kind] for kind in self.kinds if kind in cache}
+
+    def _save_cache(self) -> None:
+        """原子地写入本地缓存"""
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        cache = {'key': self.cache_key, 'time': time.time(), **self._tables}
+        tmp_file = f'{self.cache_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fcache:
+            json.dump(cache, fcache)
+        os.replace(tmp_file, self.cache_file)
+
+    def _fetch(self, kind):
+        """批量查询一类资源, 返回 名字/ID -> ID 的映射"""
+        if kind == 'images':
+            resources = self.connection.image.images()
+        elif kind == 'flavors':
+            resources = self.connection.compute.flavors()
+        else:
+            resources = self.connection.network.networks(is_router_external=True)
+        table = {}
+        for res in resources:
+            table[res.id] = res.id
+            table.setdefault(res.name, res.id)
+        return table
+
+    def _find(self, kind, name_or_id):
+        """批量列表中没有的资源(如其他项目共享的镜像)单独查找一次"""
+        if kind == 'images':
+            res = self.connection.compute.find_image(name_or_id)
+        elif kind == 'flavors':
+            res = self.connection.compute.find_flavor(name_or_id)
+        else:
+            res = self.connection.network.find_network(name_or_id)
+        return None if res is None else res.id
+
+    def resolve(self, kind, name_or_id):
+        """把名字或ID解析为ID, 找不到时抛出 LookupError"""
+        with self._lock:
+            if kind not in self._tables:
+                self._tables[kind] = self._fetch(kind)
+                self._save_cache()
+            table = self._tables[kind]
+            if name_or_id not in table:
+                res_id = self._find(kind, name_or_id)
+                if res_id is None:
+                    raise LookupError(f'{kind} {name_or_id} 不存在')
+                table[name_or_id] = res_id
+                self._save_cache()
+            return table[name_or_id]
+
+    def image_id(self, name_or_id):
+        return self.resolve('images', name_or_id)
+
+    def flavor_id(self, name_or_id):
+        return self.resolve('flavors', name_or_id)
+
+    def network_id(self, name_or_id):
+        """解析外部网络"""
+        return self.resolve('networks', name_or_id)
+
+    def invalidate(self) -> None:
+        """清空内存和本地缓存"""
+        with self._lock:
+            self._tables = {}
+            if self.cache_file is not None and os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
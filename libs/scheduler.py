@@ -0,0 +1,176 @@
+"""
+依赖图调度器, 依赖满足的任务并发执行
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from libs import trace
+
+# 各类任务的预估耗时(秒), 用于 dry-run 时估算关键路径
+ESTIMATES = {
+    'project': 3,
+    'secgroup': 2,
+    'network': 1,
+    'subnet': 1,
+    'port': 2,
+    'server': 3,
+    'wait': 60,
+    'router': 2,
+    'router-interface': 2,
+    'fip-pool': 3,
+    'floating-ip': 3,
+}
+
+
+class Task:
+    """依赖图中的一个任务
+
+    name 在图中唯一, 一般为 "类型:资源名"; func 为无参数的可调用对象;
+    limited 为 False 的任务(如等待虚拟机启动)不占用并发名额
+    """
+    def __init__(self, kind, name, func, deps=(), limited=True) -> None:
+        self.kind = kind
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.limited = limited
+        self.result = None
+        self.error = None
+
+    def __repr__(self) -> str:
+        return f'Task({self.name})'
+
+
+class Graph:
+    """任务依赖图, on_error 不为 None 时在任务失败或被跳过时调用 on_error(task)"""
+    def __init__(self, on_error=None) -> None:
+        self.tasks = {}
+        self.on_error = on_error
+
+    def add(self, kind, name, func, deps=(), limited=True) -> Task:
+        """添加任务, 已存在同名任务时直接返回已有任务"""
+        if name not in self.tasks:
+            self.tasks[name] = Task(kind, name, func, deps, limited)
+        return self.tasks[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.tasks
+
+    def topological_order(self) -> list:
+        """按添加顺序稳定排序的拓扑序, 依赖缺失或有环时抛出 ValueError"""
+        order = []
+        state = {}
+
+        def visit(task, path):
+            if state.get(task.name) == 'done':
+                return
+            if state.get(task.name) == 'visiting':
+                raise ValueError(f"依赖成环: {' -> '.join(path + [task.name])}")
+            state[task.name] = 'visiting'
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError(f'任务 {task.name} 依赖的 {dep} 不存在')
+                visit(self.tasks[dep], path + [task.name])
+            state[task.name] = 'done'
+            order.append(task)
+
+        for task in self.tasks.values():
+            visit(task, [])
+        return order
+
+    def critical_path(self, estimates=None):
+        """按预估耗时计算关键路径, 返回 (任务列表, 总耗时)"""
+        estimates = ESTIMATES if estimates is None else estimates
+        finish = {}
+        prev = {}
+        for task in self.topological_order():
+            start = 0
+            for dep in task.deps:
+                if finish[dep] > start:
+                    start = finish[dep]
+                    prev[task.name] = dep
+            finish[task.name] = start + estimates.get(task.kind, 1)
+        if not finish:
+            return [], 0
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = [self.tasks[name]]
+        while name in prev:
+            name = prev[name]
+            path.append(self.tasks[name])
+        return list(reversed(path)), total
+
+    def print_plan(self, estimates=None) -> None:
+        """打印任务图和关键路径"""
+        order = self.topological_order()
+        print(f'共 {len(order)} 个任务:')
+        for task in order:
+            deps = f" <- {', '.join(task.deps)}" if task.deps else ''
+            print(f'  [{task.kind}] {task.name}{deps}')
+        path, total = self.critical_path(estimates)
+        print(f"关键路径(预计 {total} 秒): {' -> '.join(task.name for task in path)}")
+
+    def run(self, parallel=4) -> list:
+        """执行全部任务, 同时运行的受限任务不超过 parallel 个
+
+        任务失败时, 依赖它的任务不再执行; 返回失败和跳过的任务列表
+        """
+        order = self.topological_order()
+        waiting = {task.name: set(task.deps) for task in order}
+        dependents = {task.name: [] for task in order}
+        for task in order:
+            for dep in task.deps:
+                dependents[dep].append(task)
+        failed = []
+        limited_pool = ThreadPoolExecutor(max_workers=max(parallel, 1))
+        # 不受限的任务(等待类)单独运行, 不占用并发名额
+        free_pool = ThreadPoolExecutor(max_workers=max(len(order), 1))
+        running = {}
+
+        def execute(task):
+            with trace.phase(task.kind, task.name):
+                return task.func()
+
+        def submit(task):
+            pool = limited_pool if task.limited else free_pool
+            running[pool.submit(execute, task)] = task
+
+        def skip(task):
+            """跳过依赖失败任务的所有后续任务"""
+            for child in dependents[task.name]:
+                if child.name in waiting:
+                    del waiting[child.name]
+                    child.error = f'依赖的 {task.name} 失败'
+                    failed.append(child)
+                    if self.on_error is not None:
+                        self.on_error(child)
+                    skip(child)
+
+        try:
+            for task in order:
+                if not waiting[task.name]:
+                    del waiting[task.name]
+                    submit(task)
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        task.result = future.result()
+                    except Exception as err:
+                        task.error = err
+                        failed.append(task)
+                        print(f'[ERROR] {task.name} 失败: {err}')
+                        if self.on_error is not None:
+                            self.on_error(task)
+                        skip(task)
+                        continue
+                    for child in dependents[task.name]:
+                        if child.name in waiting:
+                            waiting[child.name].discard(task.name)
+                            if not waiting[child.name]:
+                                del waiting[child.name]
+                                submit(child)
+        finally:
+            limited_pool.shutdown()
+            free_pool.shutdown()
+        return failed
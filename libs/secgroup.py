@@ -0,0 +1,112 @@
+"""
+项目安全组管理, 规则相同的虚拟机共用同一个安全组
+"""
+import hashlib
+import threading
+
+# 默认规则: 入站放通所有 tcp/udp 端口和 icmp
+DEFAULT_RULES = (('icmp', None, None), ('tcp', 1, 65535), ('udp', 1, 65535))
+DEFAULT_NAME = 'os_compose'
+DESCRIPTION = 'auto created security group rule by os_compose'
+
+
+def parse_ports(allow_ports):
+    """把配置中的 allow_ports 转换为排序后的规则元组 (协议, 起始端口, 结束端口)
+
+    allow_ports 为空时使用默认规则; 每一项可以是 22、"8000-8100" 或 "53/udp",
+    不写协议时为 tcp; 只限制端口时仍然放通 icmp
+    """
+    if not allow_ports:
+        return DEFAULT_RULES
+    rules = {('icmp', None, None)}
+    for item in allow_ports:
+        ports, _, protocol = str(item).partition('/')
+        protocol = protocol.strip().lower() or 'tcp'
+        if protocol not in ('tcp', 'udp'):
+            raise ValueError(f'不支持的协议: {item}')
+        first, _, last = ports.partition('-')
+        port_min, port_max = int(first), int(last or first)
+        if not 1 <= port_min <= port_max <= 65535:
+            raise ValueError(f'端口范围错误: {item}')
+        rules.add((protocol, port_min, port_max))
+    return tuple(sorted(rules, key=lambda rule: (rule[0], rule[1] or 0, rule[2] or 0)))
+
+
+def group_name(rules):
+    """默认规则的安全组沿用 os_compose 的名字, 其他规则按内容生成名字"""
+    if rules == DEFAULT_RULES:
+        return DEFAULT_NAME
+    digest = hashlib.sha1(repr(rules).encode()).hexdigest()[:8]
+    return f'{DEFAULT_NAME}-{digest}'
+
+
+class SecGroupManager:
+    """每个项目一次查询已有的安全组, 缺少的安全组创建一次, 规则一次批量创建
+
+    ensure() 可以在多个线程之间并发调用, 同一规则集只会创建一个安全组
+    """
+    def __init__(self, connection) -> None:
+        self.connection = connection
+        self._lock = threading.Lock()
+        self._groups = None
+        self._creating = {}
+
+    def _existing(self):
+        """一次列表查询项目已有的安全组, 按名字索引"""
+        with self._lock:
+            if self._groups is None:
+                project_id = self.connection.session.get_project_id()
+                self._groups = {group.name: group for group in
+                                self.connection.network.security_groups(project_id=project_id)}
+            return self._groups
+
+    def ensure(self, rules):
+        """返回规则集对应的安全组, 不存在时创建"""
+        name = group_name(rules)
+        groups = self._existing()
+        with self._lock:
+            if name in groups:
+                return groups[name]
+            # 同一安全组只由一个线程创建, 其他线程等待结果
+            event = self._creating.get(name)
+            owner = event is None
+            if owner:
+                event = self._creating[name] = threading.Event()
+        if not owner:
+            event.wait()
+            with self._lock:
+                if name not in groups:
+                    raise RuntimeError(f'安全组 {name} 创建失败')
+                return groups[name]
+        try:
+            group = self._create(name, rules)
+            with self._lock:
+                groups[name] = group
+            return group
+        finally:
+            with self._lock:
+                del self._creating[name]
+            event.set()
+
+    def _create(self, name, rules):
+        network = self.connection.network
+        group = network.create_security_group(name=name, description='auto created security group')
+        data = []
+        for protocol, port_min, port_max in rules:
+            rule = {
+                'description': DESCRIPTION,
+                'security_group_id': group.id,
+                # 入站规则
+                'direction': 'ingress',
+                'ethertype': 'IPv4',
+                'protocol': protocol,
+                'remote_ip_prefix': '0.0.0.0/0',
+            }
+            if port_min is not None:
+                rule['port_range_min'] = port_min
+                rule['port_range_max'] = port_max
+            data.append(rule)
+        # 一次请求创建全部规则
+        list(network.create_security_group_rules(data))
+        print(f'正在创建安全组 {name}...OK')
+        return group
@@ -0,0 +1,81 @@
+"""
+记录 os_compose 创建的资源ID的本地状态文件
+"""
+import os
+import json
+import threading
+
+
+def default_state_file(config_file):
+    """状态文件默认放在配置文件旁边, 如 vm-config.yaml -> vm-config.state.json"""
+    return f'{os.path.splitext(config_file)[0]}.state.json'
+
+
+class State:
+    """以嵌套字典保存资源ID, 每次修改后原子地写回文件
+
+    文件结构:
+        project:  {id, name}
+        secgroups: {安全组名: id}
+        router:   {id, interfaces: {cidr: port_id}}
+        networks: {cidr: {network, subnet}}
+        servers:  {vm名: {id, admin_password, ports, floating_ip: {id, address, port_id}}}
+    文件中包含虚拟机的管理员密码, 只有当前用户可读写; path 为 None 时只在内存中记录, 不写文件
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf8') as fstate:
+                self.data = json.load(fstate)
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.data)
+
+    def get(self, *keys, default=None):
+        """按路径读取, 如 get('servers', 'vm-1', 'id')"""
+        with self._lock:
+            node = self.data
+            for key in keys:
+                if not isinstance(node, dict) or key not in node:
+                    return default
+                node = node[key]
+            return node
+
+    def set(self, *keys, value) -> None:
+        """按路径写入并保存, 中间层不存在时自动创建"""
+        with self._lock:
+            node = self.data
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value
+            self._save()
+
+    def remove(self, *keys) -> None:
+        """按路径删除并保存, 路径不存在时忽略"""
+        with self._lock:
+            node = self.data
+            for key in keys[:-1]:
+                node = node.get(key, {})
+            if keys[-1] in node:
+                del node[keys[-1]]
+                self._save()
+
+    def _save(self) -> None:
+        """先写临时文件再替换, 中途退出也不会留下损坏的状态文件"""
+        if self.path is None:
+            return
+        tmp_file = f'{self.path}.tmp'
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf8') as fstate:
+            json.dump(self.data, fstate, ensure_ascii=False, indent=1)
+        os.replace(tmp_file, self.path)
+
+    def delete(self) -> None:
+        """清空状态并删除文件"""
+        with self._lock:
+            self.data = {}
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,163 @@
+"""
+按依赖层级并发清理项目资源
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from libs import trace
+from libs import events
+
+# 各层资源在事件中的类型
+TIER_KINDS = {'虚拟机': 'server', '端口': 'port', '安全组': 'secgroup', '浮动IP': 'floating_ip',
+              '路由接口': 'router_interface', '路由': 'router', '子网': 'subnet', '网络': 'network'}
+
+
+def _rid(res):
+    """资源可以是对象也可以是ID"""
+    return res if isinstance(res, str) else res.id
+
+
+class Teardown:
+    """按 虚拟机 -> 端口 -> 安全组 -> 浮动ip -> 路由接口 -> 路由 -> 子网 -> 网络 的顺序清理项目
+
+    各层的删除方法既接受资源对象也接受资源ID。每类资源只列表查询一次, 同一层级的资源并发删除, 确认整层删除完成后才开始下一层。
+    删除时遇到资源占用等冲突错误会退避重试; 限流和服务暂不可用 (429/503 等) 由 limiter 的调度器重试。
+    """
+    def __init__(self, connection, parallel=8, timeout=300, retries=5, interval=1) -> None:
+        self.connection = connection
+        self.project_id = connection.session.get_project_id()
+        self.parallel = max(parallel, 1)
+        self.timeout = timeout
+        self.retries = retries
+        self.interval = interval
+
+    def _retry(self, func, *args, **kwargs):
+        """执行删除操作, 资源仍被占用 (409) 时退避重试, 资源不存在视为已删除"""
+        from openstack import exceptions
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except exceptions.NotFoundException:
+                return None
+            except exceptions.HttpException as err:
+                in_use = isinstance(err, exceptions.ConflictException) or err.status_code == 409
+                if not in_use or attempt == self.retries:
+                    raise
+                time.sleep(self.interval * 2 ** attempt)
+
+    def _run_tier(self, name, func, resources, list_func=None):
+        """并发删除一层资源, list_func 不为 None 时等待这些资源全部消失"""
+        print(f'正在删除{name}...', end='')
+        if len(resources) == 0:
+            print('不存在')
+            return
+
+        def delete(res):
+            self._retry(func, res)
+            # 按状态文件删除时只有资源ID, 名字为空
+            events.emit('deleted', TIER_KINDS[name], getattr(res, 'name', None) or '', id=_rid(res),
+                        project_id=self.project_id)
+
+        with trace.phase('teardown', name):
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                list(executor.map(trace.bind(delete), resources))
+            if list_func is not None:
+                self._wait_gone(name, list_func, {_rid(res) for res in resources})
+        print('OK')
+
+    def _wait_gone(self, name, list_func, ids):
+        """每轮用一次列表查询确认资源已全部删除"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = ids & {res.id for res in list_func()}
+            if not remaining:
+                return
+            if time.monotonic() >= deadline:
+                print(f'WARN\n{len(remaining)} 个{name}等待删除超时')
+                return
+            time.sleep(self.interval)
+
+    def delete_servers(self, servers) -> None:
+        compute = self.connection.compute
+        self._run_tier('虚拟机', compute.delete_server, servers,
+                       lambda: compute.servers(project_id=self.project_id))
+
+    def delete_ports(self, ports) -> None:
+        network = self.connection.network
+        self._run_tier('端口', network.delete_port, ports,
+                       lambda: network.ports(project_id=self.project_id))
+
+    def delete_unbound_ports(self) -> None:
+        """删除项目中没有绑定到任何设备的端口, 如预先创建的虚拟机端口"""
+        ports = [port for port in self.connection.network.ports(project_id=self.project_id)
+                 if not port.device_owner]
+        self.delete_ports(ports)
+
+    def delete_secgroups(self, groups) -> None:
+        network = self.connection.network
+        self._run_tier('安全组', network.delete_security_group, groups,
+                       lambda: network.security_groups(project_id=self.project_id))
+
+    def delete_ips(self, ips) -> None:
+        self._run_tier('浮动IP', self.connection.network.delete_ip, ips)
+
+    def remove_interfaces(self, ports, router_id=None) -> None:
+        """ports 为端口对象, 或指定 router_id 时为端口ID"""
+        network = self.connection.network
+        self._run_tier('路由接口',
+                       lambda port: network.remove_interface_from_router(router_id or port.device_id,
+                                                                         port_id=_rid(port)),
+                       ports,
+                       lambda: network.ports(project_id=self.project_id, device_owner='network:router_interface'))
+
+    def delete_routers(self, routers) -> None:
+        network = self.connection.network
+        self._run_tier('路由', network.delete_router, routers,
+                       lambda: network.routers(project_id=self.project_id))
+
+    def delete_subnets(self, subnets) -> None:
+        network = self.connection.network
+        self._run_tier('子网', network.delete_subnet, subnets,
+                       lambda: network.subnets(project_id=self.project_id))
+
+    def delete_networks(self, networks) -> None:
+        network = self.connection.network
+        self._run_tier('网络', network.delete_network, networks,
+                       lambda: network.networks(project_id=self.project_id))
+
+    def run(self, server_names) -> None:
+        """清理项目中名字在 server_names 中的虚拟机以及全部网络资源"""
+        network = self.connection.network
+        project_id = self.project_id
+
+        # 1.虚拟机, 一次列表查询建立 名字->虚拟机 索引
+        servers_by_name = {}
+        for server in self.connection.compute.servers(project_id=project_id):
+            servers_by_name.setdefault(server.name, []).append(server)
+        servers = []
+        for name in server_names:
+            if name in servers_by_name:
+                servers.extend(servers_by_name[name])
+            else:
+                print(f'虚拟机实例 {name} 不存在')
+        self.delete_servers(servers)
+        self.delete_unbound_ports()
+        # 安全组只删除 os_compose 创建的, 项目的 default 安全组随项目删除
+        self.delete_secgroups([group for group in network.security_groups(project_id=project_id)
+                               if group.name.startswith('os_compose')])
+
+        # 2.浮动ip, 由服务端按项目过滤
+        self.delete_ips(list(network.ips(project_id=project_id)))
+
+        # 3.路由接口, 外部网关端口随路由一起删除
+        routers = list(network.routers(project_id=project_id))
+        self.remove_interfaces([port for router in routers
+                                for port in network.ports(device_id=router.id)
+                                if port.device_owner == 'network:router_interface'])
+
+        # 4.路由
+        self.delete_routers(routers)
+        # 5.子网
+        self.delete_subnets(list(network.subnets(project_id=project_id)))
+        # 6.网络
+        self.delete_networks(list(network.networks(project_id=project_id)))
@@ -0,0 +1,73 @@
+"""
+Keystone token 和服务目录的本地缓存, 连续执行的命令不必每次重新认证
+"""
+import os
+import json
+import threading
+
+DEFAULT_TOKEN_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'os_compose', 'tokens.json')
+# 管理员 token 至少要剩余的有效期(秒): 换取的项目 token 与它同时过期且不能重新认证,
+# 要够一次完整的 up (包括等待虚拟机启动的超时时间)
+TOKEN_MIN_LIFE = 1800
+
+
+class TokenCache:
+    """按认证插件的 cache id 保存认证状态 (token 和服务目录)
+
+    restore() 把未过期的认证状态装入连接, 之后的请求不再访问 Keystone;
+    save() 在认证完成后写回文件。文件中包含 token, 只有当前用户可读写。
+    """
+    def __init__(self, path=DEFAULT_TOKEN_CACHE, stale=TOKEN_MIN_LIFE) -> None:
+        self.path = path
+        # token 剩余有效期少于 stale 秒时视为过期
+        self.stale = stale
+        self._lock = threading.Lock()
+        self._states = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf8') as ftoken:
+                    self._states = json.load(ftoken)
+            except (OSError, ValueError):
+                self._states = {}
+
+    def _expired(self, state) -> bool:
+        """认证状态已过期或无法解析时返回 True"""
+        from keystoneauth1 import access
+        try:
+            data = json.loads(state)
+            auth_ref = access.create(body=data['body'], auth_token=data['auth_token'])
+            return auth_ref.will_expire_soon(self.stale)
+        except (ValueError, KeyError, TypeError):
+            return True
+
+    @staticmethod
+    def _auth(connection):
+        return getattr(connection.session, 'auth', None)
+
+    def restore(self, connection) -> bool:
+        """装入缓存的认证状态, 缓存不存在或已过期时返回 False"""
+        auth = self._auth(connection)
+        if auth is None:
+            return False
+        key = auth.get_cache_id()
+        with self._lock:
+            state = self._states.get(key)
+        if state is None or self._expired(state):
+            return False
+        auth.set_auth_state(state)
+        return True
+
+    def save(self, connection) -> None:
+        """保存连接当前的认证状态, 并清理已过期的条目"""
+        auth = self._auth(connection)
+        if auth is None or auth.auth_ref is None:
+            return
+        with self._lock:
+            self._states = {key: state for key, state in self._states.items() if not self._expired(state)}
+            self._states[auth.get_cache_id()] = auth.get_auth_state()
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_file = f'{self.path}.tmp'
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf8') as ftoken:
+                json.dump(self._states, ftoken)
+            os.replace(tmp_file, self.path)
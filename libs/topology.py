@@ -0,0 +1,34 @@
+"""
+项目网络拓扑索引, 以 CIDR 为键缓存网络和子网
+"""
+import threading
+
+
+class NetIndex:
+    """一次批量查询项目内的网络和子网, 之后的查找都在内存中完成
+
+    创建网络和子网后通过 add() 更新索引, 可以在多个线程之间共享。
+    """
+    def __init__(self, connection) -> None:
+        self._lock = threading.Lock()
+        self._index = {}
+        project_id = connection.session.get_project_id()
+        networks = {network.id: network for network in connection.network.networks(project_id=project_id)}
+        for subnet in connection.network.subnets(project_id=project_id):
+            if subnet.network_id in networks:
+                self._index[subnet.cidr] = (networks[subnet.network_id], subnet)
+
+    def get(self, cidr):
+        """根据cidr查找网络和子网, 找不到就返回 (None, None)"""
+        with self._lock:
+            return self._index.get(cidr, (None, None))
+
+    def add(self, network, subnet) -> None:
+        """记录新创建的网络和子网"""
+        with self._lock:
+            self._index[subnet.cidr] = (network, subnet)
+
+    def subnets(self):
+        """返回索引中的全部子网"""
+        with self._lock:
+            return [subnet for _, subnet in self._index.values()]
@@ -0,0 +1,175 @@
+"""
+记录每次 OpenStack API 调用所属的阶段、资源、耗时和错误, 用于分析慢在哪里
+
+start() 开启记录后, 用 wrap() 包装的连接上的每次 SDK 调用都会被记录;
+phase() 标记当前线程正在执行的阶段, 未开启记录时不做任何事
+"""
+import json
+import math
+import time
+import threading
+import contextlib
+
+from libs import limiter
+from libs.proxy import ProxyConnection, drain
+
+_tracer = None
+_local = threading.local()
+
+
+class Tracer:
+    """保存调用记录和阶段区间, 可以在多个线程之间共享"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.calls = []
+        self.spans = []
+
+    def add(self, records, **record) -> None:
+        with self._lock:
+            records.append(record)
+
+    def summary(self) -> None:
+        """打印各阶段耗时和各接口的调用次数、p50/p95 延迟"""
+        with self._lock:
+            calls = list(self.calls)
+            spans = list(self.spans)
+        print('阶段耗时:')
+        print(f"|{'阶段':<16}\t|\t{'任务数':>6}\t|\t{'合计(s)':>8}\t|\t{'区间(s)':>8}\t|\t{'API调用':>6}|")
+        phases = {}
+        for span in spans:
+            phases.setdefault(span['phase'], []).append(span)
+        for name, items in phases.items():
+            total = sum(item['dur'] for item in items)
+            elapsed = max(item['start'] + item['dur'] for item in items) - min(item['start'] for item in items)
+            count = sum(call['phase'] == name for call in calls)
+            print(f'|{name:<16}\t|\t{len(items):>6}\t|\t{total:>8.2f}\t|\t{elapsed:>8.2f}\t|\t{count:>6}|')
+        print('接口调用:')
+        print(f"|{'接口':<40}\t|\t{'次数':>5}\t|\t{'p50(ms)':>8}\t|\t{'p95(ms)':>8}\t|\t{'合计(s)':>8}\t|\t"
+              f"{'错误':>4}\t|\t{'可重试':>4}|")
+        endpoints = {}
+        for call in calls:
+            endpoints.setdefault(call['name'], []).append(call)
+        for name, items in sorted(endpoints.items(), key=lambda item: -sum(call['dur'] for call in item[1])):
+            durations = sorted(call['dur'] for call in items)
+            errors = [call for call in items if call['error']]
+            retryable = sum(call['retryable'] for call in errors)
+            print(f'|{name:<40}\t|\t{len(items):>5}\t|\t{_percentile(durations, 50) * 1000:>8.1f}\t|\t'
+                  f'{_percentile(durations, 95) * 1000:>8.1f}\t|\t{sum(durations):>8.2f}\t|\t'
+                  f'{len(errors):>4}\t|\t{retryable:>4}|')
+
+    def export(self, path) -> None:
+        """.jsonl 文件每行一条记录, 其他文件为 Chrome trace 格式 (chrome://tracing 或 Perfetto 打开)"""
+        with self._lock:
+            records = [dict(record, type='phase') for record in self.spans] + \
+                      [dict(record, type='call') for record in self.calls]
+        records.sort(key=lambda record: record['start'])
+        with open(path, 'w', encoding='utf8') as ftrace:
+            if path.endswith('.jsonl'):
+                for record in records:
+                    ftrace.write(json.dumps(record, ensure_ascii=False) + '\n')
+                return
+            events = []
+            for record in records:
+                is_call = record['type'] == 'call'
+                events.append({
+                    'name': record['name'] if is_call else record['resource'] or record['phase'],
+                    'cat': record['phase'],
+                    'ph': 'X',
+                    'ts': round(record['start'] * 1e6),
+                    'dur': round(record['dur'] * 1e6),
+                    'pid': 1,
+                    'tid': record['thread'],
+                    'args': {key: record[key] for key in ('resource', 'error', 'status') if record.get(key)},
+                })
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, ftrace, ensure_ascii=False)
+
+
+def _percentile(values, percent):
+    """values 已排序, 取最近秩百分位数"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(percent * len(values) / 100) - 1))
+    return values[index]
+
+
+def start() -> Tracer:
+    """开启记录, 之后新建的连接都会被包装"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop():
+    """停止记录, 返回记录结果"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextlib.contextmanager
+def phase(name, resource=''):
+    """标记当前线程正在执行的阶段和资源, 结束时记录阶段区间"""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    previous = getattr(_local, 'phase', None)
+    _local.phase = (name, resource)
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.phase = previous
+        tracer.add(tracer.spans, phase=name, resource=resource, start=begin - tracer.origin,
+                   dur=time.perf_counter() - begin, thread=threading.get_ident())
+
+
+def bind(func):
+    """把当前线程的阶段带到线程池中执行的函数"""
+    state = getattr(_local, 'phase', None)
+
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'phase', None)
+        _local.phase = state
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.phase = previous
+    return bound
+
+
+def wrap(connection):
+    """开启记录时返回包装后的连接, 否则原样返回"""
+    if _tracer is None or isinstance(connection, TracedConnection):
+        return connection
+    return TracedConnection(connection, _tracer)
+
+
+class TracedConnection(ProxyConnection):
+    """转发对连接的访问, 服务代理的每次调用都记录阶段、耗时和错误"""
+    def __init__(self, connection, tracer) -> None:
+        super().__init__(connection)
+        self._tracer = tracer
+
+    def wrap_call(self, service, name, func):
+        endpoint = f'{service}.{name}'
+
+        def traced(*args, **kwargs):
+            tracer = self._tracer
+            current_phase, resource = getattr(_local, 'phase', None) or ('-', '')
+            begin = time.perf_counter()
+            error, status, retryable = '', None, False
+            try:
+                return drain(func(*args, **kwargs))
+            except Exception as err:
+                error = f'{type(err).__name__}: {err}'
+                status = getattr(err, 'status_code', None)
+                # 与调度器使用同一个判断, 可重试列只统计调度器真正会重试的错误
+                retryable = limiter.retryable(name, err)
+                raise
+            finally:
+                tracer.add(tracer.calls, name=endpoint, phase=current_phase, resource=resource,
+                           start=begin - tracer.origin, dur=time.perf_counter() - begin,
+                           thread=threading.get_ident(), error=error, status=status, retryable=retryable)
+        return traced
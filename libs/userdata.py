@@ -0,0 +1,108 @@
+"""
+构建虚拟机的 user_data: 同一个脚本只读取一次, 打包为 cloud-init 多部分 MIME 后 gzip 压缩, 按内容哈希缓存
+"""
+import os
+import re
+import gzip
+import base64
+import hashlib
+import threading
+from email import charset
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+SCRIPT_DIR = 'scripts'
+# Nova 对 base64 编码后的 user_data 的长度限制
+MAX_USER_DATA = 65535
+# 脚本中的 {{变量}} 按虚拟机替换, 不影响 shell 的 $变量
+_VARIABLE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+# 脚本开头 -> cloud-init 识别的 MIME 子类型
+_PART_TYPES = (
+    ('#cloud-config', 'cloud-config'),
+    ('#cloud-boothook', 'cloud-boothook'),
+    ('#include', 'x-include-url'),
+    ('#!', 'x-shellscript'),
+)
+# 正文按原样 (8bit) 放入 MIME, 不再做一次 base64
+_UTF8 = charset.Charset('utf-8')
+_UTF8.body_encoding = None
+
+
+class UserDataBuilder:
+    """为配置了脚本的虚拟机生成 user_data, 可以在多个线程之间共享
+
+    每个脚本文件只读取一次; 脚本中没有 {{变量}} 时所有虚拟机共用同一份编码结果,
+    有变量时按替换后的内容哈希缓存, 内容相同的虚拟机同样只编码一次。
+    """
+    def __init__(self, script_dir=SCRIPT_DIR, limit=MAX_USER_DATA) -> None:
+        self.script_dir = script_dir
+        self.limit = limit
+        self._lock = threading.Lock()
+        # 脚本文件名 -> 内容
+        self._scripts = {}
+        # 内容哈希 -> 编码后的 user_data
+        self._payloads = {}
+
+    def script(self, script_file) -> str:
+        with self._lock:
+            if script_file not in self._scripts:
+                with open(os.path.join(self.script_dir, script_file), 'r', encoding='utf8') as fsc:
+                    self._scripts[script_file] = fsc.read()
+            return self._scripts[script_file]
+
+    @staticmethod
+    def variables(vm) -> dict:
+        """脚本中可以使用的变量: name, ip (第一块网卡), ips (全部网卡, 空格分隔) 以及 script_vars"""
+        variables = {
+            'name': vm.name,
+            'ip': str(vm.ip_address[0].ip) if vm.ip_address else '',
+            'ips': ' '.join(str(vm_ip.ip) for vm_ip in vm.ip_address),
+        }
+        variables.update({key: str(value) for key, value in vm.script_vars.items()})
+        return variables
+
+    def render(self, vm) -> str:
+        """替换脚本中的 {{变量}}, 未定义的变量保持原样"""
+        text = self.script(vm.script_file)
+        if '{{' not in text:
+            return text
+        variables = self.variables(vm)
+        return _VARIABLE.sub(lambda match: variables.get(match.group(1), match.group(0)), text)
+
+    @staticmethod
+    def encode(filename, text) -> str:
+        """打包为只有一个部分的 MIME 文档, gzip 压缩后 base64 编码 (cloud-init 按文件头识别 gzip)"""
+        subtype = next((subtype for prefix, subtype in _PART_TYPES if text.startswith(prefix)), 'x-shellscript')
+        part = MIMEText(text, subtype, _UTF8)
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        # 固定分隔符和 gzip 时间戳, 同样的内容每次编码结果相同
+        message = MIMEMultipart(boundary='==os_compose==')
+        message.attach(part)
+        return base64.b64encode(gzip.compress(message.as_bytes(), mtime=0)).decode()
+
+    def build(self, vm) -> str:
+        """返回虚拟机的 user_data, 编码后超过 Nova 的限制时抛出 ValueError"""
+        text = self.render(vm)
+        key = hashlib.sha256(f'{vm.script_file}\0{text}'.encode('utf8')).hexdigest()
+        with self._lock:
+            payload = self._payloads.get(key)
+        if payload is None:
+            payload = self.encode(os.path.basename(vm.script_file), text)
+            with self._lock:
+                payload = self._payloads.setdefault(key, payload)
+        if len(payload) > self.limit:
+            raise ValueError(f'{vm.name} 的脚本 {vm.script_file} 压缩编码后为 {len(payload)} 字节, '
+                             f'超过 Nova 的 {self.limit} 字节限制')
+        return payload
+
+
+# 进程内共用, 批量构建的多个项目使用同一个脚本时也只读取和编码一次
+_builder = UserDataBuilder()
+
+
+def build_user_data(vm_list, builder=None) -> None:
+    """为开启 config_driver 并指定了 script 的虚拟机设置 user_data"""
+    builder = builder or _builder
+    for vm in vm_list:
+        if vm.config_driver and vm.script_file:
+            vm.user_data = builder.build(vm)
@@ -0,0 +1,90 @@
+"""
+离线检查配置文件, 不访问 OpenStack
+"""
+import os
+
+import yaml
+import netaddr
+
+from libs.config import Config
+from libs.secgroup import parse_ports
+from libs.userdata import SCRIPT_DIR
+
+
+def _check_vm(index, vm_cfg) -> list:
+    """检查一台虚拟机的原始配置, 返回问题列表"""
+    if not isinstance(vm_cfg, dict):
+        return [f'第 {index} 台虚拟机的配置不是字典']
+    name = vm_cfg.get('name', f'第 {index} 台虚拟机')
+    problems = [f'{name} 缺少 {key}' for key in ('name', 'image', 'flavor') if not vm_cfg.get(key)]
+    # 与 Config.parse_vm 使用同样的规则展开副本
+    try:
+        count = Config.replica_count(vm_cfg)
+        if vm_cfg.get('name'):
+            Config.replica_name(vm_cfg['name'], 1, count)
+    except ValueError as err:
+        problems.append(str(err))
+    for ip in vm_cfg.get('ip_address') or []:
+        if '/' not in str(ip):
+            problems.append(f'{name} 的ip {ip} 不是CIDR形式')
+            continue
+        try:
+            netaddr.IPNetwork(ip)
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            problems.append(f'{name} 的ip {ip} 格式错误')
+    if 'float_ip' in vm_cfg:
+        try:
+            netaddr.IPNetwork(vm_cfg['float_ip'])
+        except (netaddr.AddrFormatError, ValueError, TypeError):
+            problems.append(f"{name} 的浮动ip绑定地址 {vm_cfg['float_ip']} 格式错误")
+    try:
+        parse_ports(vm_cfg.get('allow_ports'))
+    except ValueError as err:
+        problems.append(f'{name} 的 allow_ports 错误: {err}')
+    script = vm_cfg.get('script')
+    if script and not os.path.isfile(os.path.join(SCRIPT_DIR, script)):
+        problems.append(f'{name} 的脚本 {os.path.join(SCRIPT_DIR, script)} 不存在')
+    return problems
+
+
+def _overlaps(vm_list) -> list:
+    """不同写法的网段互相重叠时 (如 172.26.3.0/24 和 172.26.0.0/16), 创建子网会失败"""
+    cidrs = sorted({vm_ip.cidr for vm in vm_list for vm_ip in vm.ip_address})
+    problems = []
+    for previous, cidr in zip(cidrs, cidrs[1:]):
+        if cidr.first <= previous.last:
+            problems.append(f'网段 {previous} 与 {cidr} 重叠')
+    return problems
+
+
+def check_config(filename) -> tuple:
+    """检查一个配置文件, 返回 (项目名, 问题列表), 文件无法解析时项目名为 None
+
+    检查必填项、ip和网段格式、allow_ports、脚本是否存在、warm_pool, 再按 up 的方式解析虚拟机,
+    发现重名、ip冲突、浮动ip不在 ip_address 中、地址池不够、user_data 过大和网段重叠
+    """
+    try:
+        config = Config(filename)
+    except (OSError, yaml.YAMLError, TypeError, AttributeError) as err:
+        return None, [f'无法解析: {err}']
+    missing = [key for key, attr in (('name', 'project_name'), ('description', 'project_description'),
+                                     ('vm', 'vm_cfgs')) if not hasattr(config, attr)]
+    if missing:
+        return getattr(config, 'project_name', None), [f"project 缺少 {', '.join(missing)}"]
+    problems = []
+    if not isinstance(config.vm_cfgs, list) or not config.vm_cfgs:
+        return config.project_name, ['project.vm 应为非空列表']
+    for index, vm_cfg in enumerate(config.vm_cfgs, 1):
+        problems.extend(_check_vm(index, vm_cfg))
+    for item in config.warm_pool:
+        if not isinstance(item, dict) or not item.get('image') or not item.get('flavor'):
+            problems.append(f'warm_pool 的 {item} 缺少 image 或 flavor')
+        elif not isinstance(item.get('size', 1), int) or item.get('size', 1) < 0:
+            problems.append(f"warm_pool 的数量 {item['size']} 不是非负整数")
+    if problems:
+        return config.project_name, problems
+    try:
+        vm_list = config.parse_vm()
+    except (ValueError, KeyError) as err:
+        return config.project_name, [str(err)]
+    return config.project_name, _overlaps(vm_list)
@@ -1,4 +1,3 @@
-import os
 import netaddr
 class VM:
     name = ''
@@ -6,8 +5,6 @@ class VM:
     flavor = ''
     server = ''
     float_ip = ''
-    allow_ports = [22,80,443,445,3389,8080,5901]
-    sec_group = []
     def __init__(self,cfg:dict) -> None:
         self.ip_address = []
         self.networks = []
@@ -16,9 +13,14 @@ class VM:
         self.flavor = cfg['flavor']
         self.have_float_ip = 'no'
         self.config_driver = False
-        self.script = ''
-        self.script_file = ''
-        #self.allow_ports = cfg['ports']
+        # scripts 目录下的脚本文件, 和 script_vars 一起在解析配置时生成 user_data
+        self.script_file = cfg.get('script', '')
+        self.script_vars = cfg.get('script_vars') or {}
+        self.user_data = None
+        # 入站放通的端口, 为空时放通所有端口
+        self.allow_ports = cfg.get('allow_ports', [])
+        # 创建虚拟机前设置为对应规则的安全组
+        self.sec_group = None
         if 'ip_address' in cfg.keys():
             for ip in cfg['ip_address']:
                 self.ip_address.append(netaddr.IPNetwork(ip))
@@ -27,10 +29,6 @@ class VM:
             self.float_ip_bind = cfg['float_ip']
         if 'config_driver' in cfg.keys():
             self.config_driver = cfg['config_driver']
-        if 'script' in cfg.keys():
-            self.script_file = cfg['script']
-            with open(os.path.join('scripts',self.script_file),'r') as fsc:
-                self.script = fsc.read()
     def update(self, server) -> None:
         """接受创建的server对象"""
         self.server = server
\ No newline at end of file
@@ -0,0 +1,132 @@
+"""
+项目内预先启动好的虚拟机池, up 时直接取用, 不必等待 Nova 启动
+"""
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from libs import trace
+
+# 池中虚拟机的元数据键, 值为 "镜像ID:配额ID"; 取出后保留, down 时据此归还
+POOL_KEY = 'os_compose_pool'
+# 空闲虚拟机的名字前缀, 取出时改为配置中的名字
+WARM_PREFIX = 'os_compose-warm'
+
+
+def warm_name() -> str:
+    return f'{WARM_PREFIX}-{uuid.uuid4().hex[:8]}'
+
+
+class WarmPool:
+    """按 (镜像, 配额) 分组的预热虚拟机池
+
+    池中的虚拟机不带网卡启动 (networks='none'), 处于 ACTIVE 状态;
+    claim() 取出一台并改名, attach() 挂载按配置ip创建好的端口 (安全组设置在端口上);
+    give_back() 卸载网卡并用原镜像重建, 把用过的虚拟机恢复干净后放回池中;
+    refill() 把每组补足到指定数量。Nova 不能在项目之间转移虚拟机, 所以池就放在使用它的项目中。
+    """
+    def __init__(self, connection, parallel=4) -> None:
+        self.connection = connection
+        self.parallel = max(parallel, 1)
+        self._lock = threading.Lock()
+        # 镜像ID:配额ID -> 可以取用的虚拟机
+        self._idle = {}
+
+    @staticmethod
+    def key(image_id, flavor_id) -> str:
+        return f'{image_id}:{flavor_id}'
+
+    @staticmethod
+    def is_idle(server) -> bool:
+        """池中未被取用的虚拟机"""
+        return server.name.startswith(WARM_PREFIX)
+
+    def members(self) -> list:
+        """项目中属于池的虚拟机, 包括已被取用的"""
+        project_id = self.connection.session.get_project_id()
+        return [server for server in self.connection.compute.servers(details=True, project_id=project_id)
+                if POOL_KEY in (server.metadata or {})]
+
+    def load(self) -> int:
+        """一次列表查询找出可以取用的虚拟机, 返回数量"""
+        idle = {}
+        for server in self.members():
+            if self.is_idle(server) and server.status == 'ACTIVE':
+                idle.setdefault(server.metadata[POOL_KEY], []).append(server)
+        with self._lock:
+            self._idle = idle
+        return sum(len(servers) for servers in idle.values())
+
+    def claim(self, image_id, flavor_id, name):
+        """取出一台镜像和配额匹配的虚拟机并改名为 name, 没有时返回 None"""
+        with self._lock:
+            servers = self._idle.get(self.key(image_id, flavor_id))
+            if not servers:
+                return None
+            server = servers.pop()
+        return self.connection.compute.update_server(server, name=name)
+
+    def attach(self, server, ports) -> None:
+        for port in ports:
+            self.connection.compute.create_server_interface(server, port_id=port.id)
+
+    def give_back(self, server) -> None:
+        """卸载虚拟机的全部网卡, 用原镜像重建并改回池中的名字"""
+        compute = self.connection.compute
+        for interface in list(compute.server_interfaces(server)):
+            compute.delete_server_interface(interface, server=server)
+        image_id, _ = server.metadata[POOL_KEY].split(':', 1)
+        compute.rebuild_server(server, image_id, name=warm_name(), metadata=dict(server.metadata))
+
+    def return_servers(self, servers) -> None:
+        """并发归还虚拟机, 归还失败的改为删除"""
+        from openstack import exceptions
+
+        def give_back(server):
+            try:
+                self.give_back(server)
+            except exceptions.SDKException as err:
+                print(f'[WARNING] 虚拟机 {server.name} 归还失败, 改为删除: {err}')
+                self.connection.compute.delete_server(server, ignore_missing=True)
+
+        print(f'正在归还虚拟机到预热池 {len(servers)} 台...', end='')
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            list(executor.map(trace.bind(give_back), servers))
+        print('OK')
+
+    def refill(self, targets, poller=None) -> None:
+        """targets 为 {(镜像ID, 配额ID): 数量}, 启动中和重建中的虚拟机也计入数量;
+        出错的虚拟机删除后补上, 指定 poller 时等待新虚拟机启动完成"""
+        from openstack import exceptions
+        compute = self.connection.compute
+        counts = {}
+        broken = []
+        for server in self.members():
+            if not self.is_idle(server):
+                continue
+            if server.status == 'ERROR':
+                broken.append(server)
+                continue
+            counts[server.metadata[POOL_KEY]] = counts.get(server.metadata[POOL_KEY], 0) + 1
+        for server in broken:
+            compute.delete_server(server, ignore_missing=True)
+
+        def boot(item):
+            image_id, flavor_id = item
+            return compute.create_server(name=warm_name(), image_id=image_id, flavor_id=flavor_id,
+                                         networks='none', metadata={POOL_KEY: self.key(image_id, flavor_id)})
+
+        missing = [(image_id, flavor_id) for (image_id, flavor_id), size in targets.items()
+                   for _ in range(size - counts.get(self.key(image_id, flavor_id), 0))]
+        print(f'正在补充预热池 {len(missing)} 台 (删除出错的 {len(broken)} 台)...', end='')
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            servers = list(executor.map(trace.bind(boot), missing))
+        print('OK')
+        if poller is not None:
+            for server in servers:
+                poller.watch(server)
+            for server in servers:
+                try:
+                    poller.wait_for(server)
+                except (exceptions.ResourceFailure, exceptions.ResourceTimeout) as err:
+                    print(f'[WARNING] {err}')
@@ -3,88 +3,115 @@
 """
 import os
 import sys
+import glob
+import contextlib
+import threading
 import netaddr
 import argparse
-import openstack
+import importlib.util
 from libs.config import Config
-import base64
+from libs.poller import ServerPoller
+from libs.topology import NetIndex
+from libs.resolver import Resolver, DEFAULT_CACHE_FILE
+from libs.teardown import Teardown
+from libs.scheduler import Graph
+from libs.reconcile import Reconciler
+from libs.state import State, default_state_file
+from libs.fippool import FloatingIPPool
+from libs.secgroup import SecGroupManager, parse_ports, group_name
+from libs import trace
+from libs import limiter
+from libs import events
+from libs.limiter import parse_service_limits
+from libs.tokens import TokenCache, DEFAULT_TOKEN_CACHE, TOKEN_MIN_LIFE
+from libs.ipam import gateway_ip
+from libs.warmpool import WarmPool
+from libs.validate import check_config
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
-# 配置 OpenStack 连接信息
-auth_args = {
-    "auth_url":          os.environ["OS_AUTH_URL"],
-    "project_name":      os.environ["OS_PROJECT_NAME"],
-    "project_domain_id": os.environ["OS_PROJECT_ID"],
-    "username":          os.environ["OS_USERNAME"],
-    "user_domain_name":  os.environ["OS_USER_DOMAIN_NAME"],
-    "password":          os.environ["OS_PASSWORD"],
+def lazy_import(name):
+    """第一次访问模块属性时才真正导入, validate 等不访问 OpenStack 的命令不必加载整个 SDK"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+openstack = lazy_import('openstack')
+
+# OpenStack 连接信息 -> 环境变量
+AUTH_ENV = {
+    "auth_url":          "OS_AUTH_URL",
+    "project_name":      "OS_PROJECT_NAME",
+    "project_domain_id": "OS_PROJECT_ID",
+    "username":          "OS_USERNAME",
+    "user_domain_name":  "OS_USER_DOMAIN_NAME",
+    "password":          "OS_PASSWORD",
 }
 
 
+def auth_args():
+    """从环境变量读取 OpenStack 连接信息, 只有需要访问 OpenStack 的命令才会调用"""
+    missing = [env for env in AUTH_ENV.values() if env not in os.environ]
+    if missing:
+        raise RuntimeError(f"缺少 OpenStack 连接信息, 请设置环境变量: {', '.join(missing)}")
+    return {key: os.environ[env] for key, env in AUTH_ENV.items()}
+
+
 # 定义创建 VM 的函数
-def create_vm(conn, vm_cfg, networks):
+def create_vm(conn, vm_cfg, networks, resolver=None):
     """根据传入的name、image、flavor、subnet_id、ip地址创建VM"""
-    print('正在创建虚拟机...', end='')
+    if resolver is None:
+        resolver = Resolver(conn)
+    # 获取镜像和配额ID
+    image_id = resolver.image_id(vm_cfg.image)
+    flavor_id = resolver.flavor_id(vm_cfg.flavor)
+    attrs = {}
+    if vm_cfg.config_driver == True:
+        attrs['config_drive'] = vm_cfg.config_driver
+        # user_data 在解析配置时已经压缩编码, 并检查过大小
+        if vm_cfg.user_data:
+            attrs['user_data'] = vm_cfg.user_data
     try:
-        # 获取镜像和配额对象
-        image_obj = conn.compute.find_image(vm_cfg.image)
-        flavor_obj = conn.compute.find_flavor(vm_cfg.flavor)
-
         # 创建 VM
-        if vm_cfg.config_driver == True:
-            server = conn.compute.create_server(
-                name=vm_cfg.name,
-                image_id=image_obj.id,
-                flavor_id=flavor_obj.id,
-                networks=networks,
-                security_groups=[{'name': vm_cfg.sec_group[0].name}],
-                config_drive=vm_cfg.config_driver,
-                user_data = base64.b64encode(vm_cfg.script.encode('utf8')).decode() #TODO: 脚本大小不能超过16kb
-            )
-        else:
-            server = conn.compute.create_server(
-                name=vm_cfg.name,
-                image_id=image_obj.id,
-                flavor_id=flavor_obj.id,
-                networks=networks,
-                security_groups=[{'name': vm_cfg.sec_group[0].name}]
-            )
-        print('OK')
+        server = conn.compute.create_server(
+            name=vm_cfg.name,
+            image_id=image_id,
+            flavor_id=flavor_id,
+            networks=networks,
+            security_groups=[{'name': vm_cfg.sec_group.name}],
+            **attrs
+        )
+        print(f'正在创建虚拟机 {vm_cfg.name}...OK')
     except openstack.exceptions.BadRequestException as err: # type: ignore
         #print('ip 地址重复, 尝试分配新ip...')
-        print(f'WARN\n{err}')
-        # 获取镜像和配额对象
-        image_obj = conn.compute.find_image(vm_cfg.image)
-        flavor_obj = conn.compute.find_flavor(vm_cfg.flavor)
+        print(f'正在创建虚拟机 {vm_cfg.name}...WARN\n{err}')
         # 删除指定的ip地址
         for dic in networks:
-            dic.pop('fixed_ip')
+            dic.pop('fixed_ip', None)
 
         # 创建 VM
         server = conn.compute.create_server(
             name=vm_cfg.name,
-            image_id=image_obj.id,
-            flavor_id=flavor_obj.id,
+            image_id=image_id,
+            flavor_id=flavor_id,
             networks=networks,
             #networks=[{"uuid": net_id, "fixed_ip": ip_address}],
-            security_groups=[{'name': vm_cfg.sec_group[0].name}]
+            security_groups=[{'name': vm_cfg.sec_group.name}],
+            **attrs
         )
-        print('正在创建虚拟机...OK')
+        print(f'正在创建虚拟机 {vm_cfg.name}...OK')
     except openstack.exceptions.ResourceTimeout: # type: ignore
         print(f"ERROR Created VM waiting timeout")
 
     return server
 
-def delete_vm(conn, vm_cfg):
-    """删除已创建的虚拟机"""
-    servers = conn.compute.servers()
-    servers_dict = {server.name : server.id for server in servers}
-    if vm_cfg.name in servers_dict.keys():
-        conn.compute.delete_server(servers_dict[vm_cfg.name])
-        print(f'虚拟机实例 {vm_cfg.name} 删除成功')
-    else:
-        print(f'虚拟机实例 {vm_cfg.name} 不存在')
-
 def create_subnet(conn, network, cidr_prefix, gw_ip):
     """定义创建 Subnet 的函数，将需要动态计算 CIDR 的变量作为参数传递"""
 
@@ -125,63 +152,33 @@ def create_subnet(conn, network, cidr_prefix, gw_ip):
 
     return subnet
 
-def delete_route_network(conn):
-    """删除路由、网络和子网"""
-    print('正在删除路由...', end='')
-    routers = list(conn.network.routers(project_id=conn.session.get_project_id()))
-    if len(routers) == 0:
-        print('路由不存在！')
-    else:
-        for port in conn.network.ports(device_id=routers[0].id):
-            if port.network_id == '9107647b-c57b-475a-832a-79d8306089cb':
-                continue
-            # TODO: 端口可能占用无法删除
-            conn.network.remove_interface_from_router(routers[0].id, port_id=port.id)
-        conn.network.delete_router(routers[0])
-        print('OK')
-    print('正在删除子网...',end='')
-    subnets = conn.network.subnets(project_id=conn.session.get_project_id())
-    for subnet in subnets:
-        conn.network.delete_subnet(subnet.id)
-    print('OK')
-    print('正在删除网络...',end='')
-
-    networks = conn.network.networks(project_id=conn.session.get_project_id())
-    for network in networks:
-        conn.network.delete_network(network.id)
-    print('OK')
-
-
-def find_net(connection, cidr):
-    """根据传入的cidr在当前项目中查找subnet, 如果找不到就返回None"""
-    subnets = connection.network.subnets(project_id=connection.session.get_project_id())
-    subnet_list = list(subnets)
-    for _subnet in subnet_list:
-        if _subnet.cidr == cidr:
-            network = connection.network.find_network(_subnet.network_id)
-            return network, _subnet
-    return None, None
-
-def create_router(connection, subnets, external_network_name=None):
-    """创建路由，连接指定子网"""
+def create_router(connection, external_network_name=None, resolver=None):
+    """创建路由, 指定外部网络时设置网关"""
     router_name = 'auto-created-router'
+    # 项目中已有路由时直接复用
+    router = connection.network.find_router(router_name, project_id=connection.session.get_project_id())
+    if router is not None:
+        return router
     if external_network_name is not None:
-        external_network = connection.network.find_network(external_network_name)
+        if resolver is None:
+            resolver = Resolver(connection)
         router = connection.network.create_router(
             name=router_name,
-            external_gateway_info={'network_id': external_network.id}
+            external_gateway_info={'network_id': resolver.network_id(external_network_name)}
             )
     else:
         router = connection.network.create_router(name=router_name)
     print(f"路由 {router.name} 创建完成, ID为: '{router.id}'")
+    return router
+
+def add_router_interface(connection, router, subnet):
+    """连接子网到路由"""
     try:
-        for subnet in subnets:
-            connection.network.add_interface_to_router(router, subnet_id=subnet.id)
-            print(f"连接子网 {subnet.name} 到路由 {router.name} ")
+        interface = connection.network.add_interface_to_router(router, subnet_id=subnet.id)
+        print(f"连接子网 {subnet.name} 到路由 {router.name} ")
+        return interface
     except openstack.exceptions.BadRequestException as e:
         print(f'[WARNING] {e}')
-        pass
-    return router
 
 
 
@@ -190,8 +187,7 @@ def create_project(connection, project_name=None, description=None):
     print('正在创建项目...', end='')
     try:
         project = connection.identity.create_project(name=project_name, description=description)
-        admin = connection.identity.find_user(name_or_id=auth_args["username"])
-        admin_role = connection.identity.find_role('admin')
+        admin, admin_role = admin_identity(connection)
         # 将当前用户加入新创建的project
         connection.identity.assign_project_role_to_user(project, admin, admin_role)
         print('OK')
@@ -200,234 +196,855 @@ def create_project(connection, project_name=None, description=None):
         print(f"WARN\n{project_name} 已存在! 跳过创建...")
         project = connection.identity.find_project(name_or_id=project_name)
 
+    return connect_project(project.id, project.name), project
+
+def connect(**kwargs):
+    """连接 OpenStack, 开启调用记录或调用数量限制时返回包装后的连接"""
+    return limiter.wrap(trace.wrap(openstack.connect(**kwargs)))
+
+# 同一进程内共用的管理员连接和当前用户、admin 角色
+_admin = {}
+_admin_lock = threading.Lock()
+# token 和服务目录的本地缓存, 为 None 时不缓存
+token_cache = None
+
+def authenticate(connection):
+    """完成认证, 有未过期的 token 缓存时直接使用缓存"""
+    if token_cache is not None and token_cache.restore(connection):
+        return
+    connection.session.get_token()
+    if token_cache is not None:
+        token_cache.save(connection)
 
-    new_auth_args = auth_args.copy()
-    new_auth_args['project_name'] = project_name
-    new_auth_args['project_id'] = project.id
-    new_conn = openstack.connect(**new_auth_args)
+def connect_admin():
+    """返回共用的管理员连接, 同一进程内只用密码认证一次"""
+    with _admin_lock:
+        if 'connection' not in _admin:
+            connection = connect(**auth_args())
+            authenticate(connection)
+            _admin['connection'] = connection
+        return _admin['connection']
 
-    return new_conn, project
+def admin_identity(connection):
+    """返回当前用户和 admin 角色, 只查询一次"""
+    with _admin_lock:
+        if 'identity' not in _admin:
+            _admin['identity'] = (connection.identity.find_user(name_or_id=auth_args()["username"]),
+                                  connection.identity.find_role('admin'))
+        return _admin['identity']
 
+def connect_project(project_id, project_name):
+    """返回指定project的连接对象
+
+    用管理员连接的 token 换取项目范围的 token (token rescope), 不再用密码重新认证;
+    换取的 token 与管理员 token 同时过期, 管理员 token 剩余有效期不到 TOKEN_MIN_LIFE 时先用密码重新认证
+    """
+    admin_connection = connect_admin()
+    auth = getattr(admin_connection.session, 'auth', None)
+    with _admin_lock:
+        if auth is not None and auth.auth_ref is not None and auth.auth_ref.will_expire_soon(TOKEN_MIN_LIFE):
+            auth.invalidate()
+        token = admin_connection.session.get_token()
+    connection = connect(auth_url=auth_args()['auth_url'], auth_type='v3token', token=token,
+                         project_id=project_id)
+    authenticate(connection)
+    return connection
 
 
 def delete_project(connection, project):
     """删除project"""
     connection.identity.delete_project(project)
 
-def create_networks(connection, vm_config):
-    """根据网络配置创建网络及子网,并返回openstack网络配置"""
-    print('正在创建网络...', end='')
-    subnets = {}
-    networks = []
-    # 遍历配置文件中的net列表，获取 IP 地址和掩码
-    for vm_ip in vm_config.ip_address:
-        cidr_prefix = str(vm_ip.cidr)
-        vm_config.cidr = cidr_prefix
+def create_network(connection, cidr_prefix):
+    """为指定网段创建网络"""
+    network_name = f"auto-created-network-{cidr_prefix}"
+    print(f'正在创建网络 {network_name}')
+    return connection.network.create_network(name=network_name)
 
-        # 检查子网是否存在，如果不存在则创建
+def ip_conflicts(connection, subnet, requests):
+    """一次查询子网中已占用的ip, 返回 requests 中冲突的 (虚拟机名, ip)"""
+    used = {subnet.gateway_ip}
+    for port in connection.network.ports(network_id=subnet.network_id):
+        used.update(fixed['ip_address'] for fixed in port.fixed_ips)
+    return [(vm_name, ip) for vm_name, ip in requests if ip in used]
 
-        network, subnet = find_net(connection, cidr_prefix)
+def conflict_error(conflicts):
+    return ValueError('以下ip已被占用: ' + ', '.join(f'{vm_name} {ip}' for vm_name, ip in conflicts))
 
-        # 如果没有找到网络和子网，就尝试创建
-        if network == None and subnet == None:
-            network_name = f"auto-created-network-{cidr_prefix}"
-            network = connection.network.create_network(name=network_name)
-            # 计算网关ip
-            gw_ip = str(netaddr.IPAddress(vm_ip.first + 254))
-            if vm_config.have_float_ip == 'yes' and vm_ip.ip == netaddr.IPNetwork(vm_config.float_ip_bind).ip:
-                subnet = create_subnet(connection, network, cidr_prefix, gw_ip)
-            else:
-                subnet = create_subnet(connection, network, cidr_prefix, '')
-
-        vm_config.networks.append(network)
-        # 将子网对象添加到 subnets 列表中
-        subnets[str(vm_ip.ip)] = subnet
-        networks.append({"uuid": subnet.network_id, "fixed_ip": vm_ip.ip})
-        
-    print('OK')
-    return networks, subnets
-
-def add_float_ip(connection, server, ipaddr):
-    """根据配置信息找到需要绑定浮动ip的接口, 分配并绑定浮动ip"""
+def create_ports(connection, subnet, requests, sec_groups, check=True):
+    """在子网中一次批量创建端口, requests 为 (虚拟机名, ip) 列表, 返回 {(虚拟机名, ip): 端口}
+
+    sec_groups 为 {虚拟机名: 安全组}, 端口使用所属虚拟机的安全组
+
+    批量创建任何一个端口失败都会整批失败, 所以 check 为 True 时先查询子网中已占用的ip,
+    有冲突时抛出 ValueError 列出全部冲突的ip, 不创建任何端口, 也不会改用其他ip
+    """
+    if check:
+        conflicts = ip_conflicts(connection, subnet, requests)
+        if conflicts:
+            raise conflict_error(conflicts)
+    data = []
+    for vm_name, ip in requests:
+        data.append({
+            'name': f'{vm_name}-{ip}',
+            'network_id': subnet.network_id,
+            'fixed_ips': [{'subnet_id': subnet.id, 'ip_address': ip}],
+            # 以端口创建虚拟机时, 安全组要设置在端口上
+            'security_group_ids': [sec_groups[vm_name].id],
+        })
+    ports = list(connection.network.create_ports(data))
+    print(f'正在创建子网 {subnet.name} 的端口...OK')
+    return dict(zip(requests, ports))
+
+def add_float_ip(connection, server, ipaddr, resolver=None, port_id=None, pool=None):
+    """根据配置信息找到需要绑定浮动ip的接口, 分配并绑定浮动ip
+
+    已知端口ID时不再查询虚拟机的端口; 指定浮动ip池时从池中取出已分配好的浮动ip绑定,
+    否则在创建浮动ip时直接绑定
+    """
     # print(f'正在分配浮动ip 到 {server.name}')
-    provider = connection.network.find_network(name_or_id='provider')
-    floating_ip  = connection.network.create_ip(floating_network_id=provider.id)
-    ports = connection.network.ports(device_id=server.id)
-    for port in list(ports):
-        ip_dict = port.fixed_ips[0]
-        if ip_dict['ip_address'] == ipaddr:
-            connection.network.update_ip(floating_ip, port_id=port.id)
-    return floating_ip
-
-def delete_float_ip(connection):
-    print('正在释放浮动IP...', end='')
-    float_ips = list(connection.network.ips())
-    for float_ip in float_ips:
-        if float_ip.project_id == connection.session.get_project_id():
-            connection.network.delete_ip(float_ip)
-    print('OK')
-        
-
-def create_secgroup(connection, vm_onfig):
-    """以默认配置创建安全组, 入站放通所有tcp端口"""
-    sec_group = connection.network.find_security_group(name_or_id='os_compose',
-        project_id=connection.session.get_project_id())
-    if sec_group is None:
-        sec_rule = {
-            'description': 'auto created security group rule by os_compose',
-            # 出站规则
-            'direction': 'ingress',
-            #: 可选项有 ``null``, ``tcp``, ``udp``, and ``icmp``.
-            'protocol': 'tcp',
-            #: The maximum port number in the range that is matched by the
-            #: security group rule. The port_range_min attribute constrains
-            #: the port_range_max attribute. If the protocol is ICMP, this
-            #: value must be an ICMP type.
-            'port_range_max': 65535,
-            #: The minimum port number in the range that is matched by the
-            #: security group rule. If the protocol is TCP or UDP, this value
-            #: must be less than or equal to the value of the port_range_max
-            #: attribute. If the protocol is ICMP, this value must be an ICMP type.
-            'port_range_min': 1,
-            'remote_ip_prefix': '0.0.0.0/0',
-        }
-        sec_group = connection.network.create_security_group(name='os_compose',
-            description='auto created security group')
-        #sec_rule['security_group_id'] = sec_group.id
-        # allow all tcp port
-        connection.network.create_security_group_rule(
-            description=sec_rule['description'],
-            security_group_id=sec_group.id,
-            direction=sec_rule['direction'],
-            protocol=sec_rule['protocol'],
-            port_range_max=sec_rule['port_range_max'],
-            port_range_min=sec_rule['port_range_min'],
-            remote_ip_prefix=sec_rule['remote_ip_prefix'],
-            )
-        # allow all icmp 
-        connection.network.create_security_group_rule(
-            description=sec_rule['description'],
-            security_group_id=sec_group.id,
-            direction=sec_rule['direction'],
-            protocol='icmp',
-            port_range_max=sec_rule['port_range_max'],
-            port_range_min=sec_rule['port_range_min'],
-            remote_ip_prefix=sec_rule['remote_ip_prefix'],
-            )
-        
-        # allow all udp port
-        connection.network.create_security_group_rule(
-            description=sec_rule['description'],
-            security_group_id=sec_group.id,
-            direction=sec_rule['direction'],
-            protocol='udp',
-            port_range_max=sec_rule['port_range_max'],
-            port_range_min=sec_rule['port_range_min'],
-            remote_ip_prefix=sec_rule['remote_ip_prefix'],
-            )
-    vm_onfig.sec_group.append(sec_group)
-    return sec_group
+    if port_id is None:
+        for port in connection.network.ports(device_id=server.id):
+            if any(ip_dict['ip_address'] == ipaddr for ip_dict in port.fixed_ips):
+                port_id = port.id
+    if pool is not None:
+        return pool.bind(pool.acquire(), port_id)
+    if resolver is None:
+        resolver = Resolver(connection)
+    return connection.network.create_ip(floating_network_id=resolver.network_id('provider'), port_id=port_id)
 
+class Context:
+    """up 过程中各任务共享的连接和索引, 由 project 任务填充
 
-def up(filename='vm-config.yaml'):
-    """读取 YAML 配置文件并创建 VM"""
-    config = Config(filename)
-    project_name = config.project_name
-    project_description = config.project_description
-    vm_list = config.parse_vm()
+    connection 预先设置时(如 apply 已有项目)不再创建项目, resolver 预先设置时直接复用
+    """
+    def __init__(self, connection=None, state=None) -> None:
+        self.connection = connection
+        self.project = None
+        self.net_index = None
+        self.resolver = None
+        self.poller = None
+        self.fip_pool = None
+        self.sec_groups = None
+        # 配置了预热池时可以取用的虚拟机, 为 None 时都新建
+        self.warm_pool = None
+        # 批量构建时各项目共用的启动名额, 为 None 时不限制
+        self.boot_slots = None
+        # 记录已创建资源ID的状态文件, 为 None 时不记录
+        self.state = state
+        # 本次新建的子网, 已有的子网不再连接路由
+        self.created_subnets = set()
+
+    def record(self, *keys, value) -> None:
+        """把资源ID写入状态文件"""
+        if self.state is not None:
+            self.state.set(*keys, value=value)
+
+
+def plan_up(config, vm_list, ctx, cache_file=None, cache_ttl=3600, invalidate_cache=False, port_first=False):
+    """根据配置构建 up 的任务依赖图
+
+    project -> secgroup / network -> subnet -> server -> wait -> floating-ip,
+    router -> router-interface -> floating-ip, project -> fip-pool -> floating-ip;
+    各任务在执行时才访问 OpenStack。
+    port_first 为 True 时, 每个网段的端口先按指定ip一次批量创建 (subnet -> port -> server),
+    虚拟机以端口启动, 浮动ip直接绑定到已知端口;
+    每个资源创建或失败时发出事件, 虚拟机启动完成并绑定浮动ip后发出 ready 事件
+    """
+    def emit(event, kind, name, **fields):
+        events.emit(event, kind, name, project=config.project_name, **fields)
+
+    graph = Graph(on_error=lambda task: emit('failed', 'task', task.name, error=str(task.error)))
+
+    def result(name):
+        return graph.tasks[name].result
+
+    def ready(vm_config, server):
+        emit('ready', 'server', vm_config.name, id=server.id, status=server.status,
+             ips=[addr['addr'] for addrs in (server.addresses or {}).values() for addr in addrs],
+             floating_ip=vm_config.float_ip or None, admin_password=vm_config.server.admin_password)
+
+    def project_task():
+        # 连接 OpenStack，创建指定项目，并返回新项目的连接对象
+        if ctx.connection is None:
+            admin_connection = connect_admin()
+            ctx.connection, ctx.project = create_project(admin_connection, config.project_name, config.project_description)
+            ctx.record('project', value={'id': ctx.project.id, 'name': ctx.project.name})
+            emit('created', 'project', ctx.project.name, id=ctx.project.id)
+        # 一次查询项目已有的网络和子网, 所有虚拟机共用
+        ctx.net_index = NetIndex(ctx.connection)
+        # 镜像、配额和外部网络只批量查询一次
+        if ctx.resolver is None:
+            ctx.resolver = Resolver(ctx.connection, cache_file, cache_ttl, auth_args()['auth_url'])
+        if invalidate_cache:
+            ctx.resolver.invalidate()
+        ctx.poller = ServerPoller(ctx.connection)
+        ctx.sec_groups = SecGroupManager(ctx.connection)
+        if config.warm_pool:
+            ctx.warm_pool = WarmPool(ctx.connection)
+            ctx.warm_pool.load()
+            ctx.record('warm_pool', value=True)
+    graph.add('project', 'project', project_task)
+
+    def secgroup_task(rules):
+        sec_group = ctx.sec_groups.ensure(rules)
+        ctx.record('secgroups', sec_group.name, value=sec_group.id)
+        emit('created', 'secgroup', sec_group.name, id=sec_group.id)
+        return sec_group
 
-    # 连接 OpenStack，创建一个空 subnet_id 列表以存储创建的子网 ID
-    admin_connection = openstack.connect(**auth_args)
-    # 可互通网络列表
-    interoperable = []
-    # 创建指定项目，并返回新项目的连接对象
-    connection, project = create_project(admin_connection, project_name, project_description)
-    # 处理虚拟机配置
+    # 规则相同的虚拟机共用一个安全组, 每个安全组只查询或创建一次
+    secgroup_of = {}
     for vm_config in vm_list:
-        # 处理虚拟机网络配置
-        networks, subnets = create_networks(connection,vm_config)
-        # 创建安全组和默认安全组规则
-        create_secgroup(connection, vm_config)
-        # 2.创建 VM
-        server = create_vm(
-            conn=connection,
-            vm_cfg=vm_config,
-            networks=networks
-        )
-        #connection.compute.set_server_metadata(server,)
-        vm_config.update(server)
-        if hasattr(vm_config, 'float_ip_bind'):
-            interoperable.append(subnets[vm_config.float_ip_bind])
+        rules = parse_ports(vm_config.allow_ports)
+        secgroup_of[vm_config.name] = f'secgroup:{group_name(rules)}'
+        graph.add('secgroup', secgroup_of[vm_config.name],
+                  lambda rules=rules: secgroup_task(rules), ['project'])
 
-    # 3.根据配置文件创建路由
-    create_router(connection, interoperable,'provider')
-    # 等待虚拟机创建完成，并打印相关信息
-    #time.sleep(180)
-    wait_and_print(connection, vm_list)
+    # 需要绑定浮动ip的网段要设置网关并连接到路由
+    float_cidrs = {str(vm_ip.cidr) for vm_config in vm_list if vm_config.have_float_ip == 'yes'
+                   for vm_ip in vm_config.ip_address if str(vm_ip.ip) == vm_config.float_ip_bind}
 
+    def network_task(cidr_prefix):
+        network, _ = ctx.net_index.get(cidr_prefix)
+        if network is None:
+            network = create_network(ctx.connection, cidr_prefix)
+        ctx.record('networks', cidr_prefix, 'network', value=network.id)
+        emit('created', 'network', cidr_prefix, id=network.id)
+        return network
 
-    print('openstack 项目构建完成!')
+    def subnet_task(cidr_prefix):
+        network, subnet = ctx.net_index.get(cidr_prefix)
+        if subnet is None:
+            network = result(f'network:{cidr_prefix}')
+            # 计算网关ip
+            gw_ip = gateway_ip(cidr_prefix, cidr_prefix in float_cidrs)
+            subnet = create_subnet(ctx.connection, network, cidr_prefix, gw_ip)
+            ctx.net_index.add(network, subnet)
+            ctx.created_subnets.add(cidr_prefix)
+        ctx.record('networks', cidr_prefix, 'subnet', value=subnet.id)
+        emit('created', 'subnet', cidr_prefix, id=subnet.id)
+        return subnet
 
-def wait_and_print(connection, vm_list):
-    """等待虚拟机创建完成, 根据配置绑定浮动ip, 并打印相关信息"""
-    print('正在等待虚拟机创建完成...')
+    def router_interface_task(cidr_prefix):
+        # 已有的子网在之前构建时已经连接到路由
+        if cidr_prefix in ctx.created_subnets:
+            interface = add_router_interface(ctx.connection, result('router'), result(f'subnet:{cidr_prefix}'))
+            if interface:
+                ctx.record('router', 'interfaces', cidr_prefix, value=interface['port_id'])
+                emit('created', 'router_interface', cidr_prefix, id=interface['port_id'])
+
+    # 每个网段上需要创建端口的 (虚拟机名, ip)
+    port_requests = {}
     for vm_config in vm_list:
-        try:
-            server = connection.compute.wait_for_server(vm_config.server)
-            if vm_config.have_float_ip == 'yes':
-                floatip = add_float_ip(connection, server, vm_config.float_ip_bind)
-                ip_address = server.addresses
-                vm_config.float_ip = floatip.floating_ip_address
-                ip_list = [ip_address[net][0]['addr'] for net in ip_address.keys()]
-                print(f"|{server.name}\t|\t{ip_list}:{vm_config.float_ip}\t|\t{server.admin_password}|")
+        for vm_ip in vm_config.ip_address:
+            port_requests.setdefault(str(vm_ip.cidr), []).append((vm_config.name, str(vm_ip.ip)))
+
+    def ip_check_task():
+        """所有子网就绪后一次检查全部网段的ip冲突, 有冲突时不创建任何端口和虚拟机"""
+        conflicts = []
+        for cidr_prefix, requests in port_requests.items():
+            conflicts += ip_conflicts(ctx.connection, result(f'subnet:{cidr_prefix}'), requests)
+        if conflicts:
+            raise conflict_error(conflicts)
+
+    def ports_task(cidr_prefix):
+        sec_groups = {vm_name: result(secgroup_of[vm_name]) for vm_name, _ in port_requests[cidr_prefix]}
+        return create_ports(ctx.connection, result(f'subnet:{cidr_prefix}'), port_requests[cidr_prefix], sec_groups,
+                            check=False)
+
+    def port_of(vm_config, vm_ip):
+        return result(f'ports:{vm_ip.cidr}')[(vm_config.name, str(vm_ip.ip))]
+
+    def claim_task(vm_config):
+        # 启动后不能再注入 user_data, 带脚本的虚拟机不从预热池取用
+        if ctx.warm_pool is None or vm_config.user_data:
+            return None, []
+        server = ctx.warm_pool.claim(ctx.resolver.image_id(vm_config.image),
+                                     ctx.resolver.flavor_id(vm_config.flavor), vm_config.name)
+        if server is None:
+            return None, []
+        ports = []
+        for vm_ip in vm_config.ip_address:
+            if port_first:
+                ports.append(port_of(vm_config, vm_ip))
+            else:
+                request = (vm_config.name, str(vm_ip.ip))
+                ports.append(create_ports(ctx.connection, result(f'subnet:{vm_ip.cidr}'), [request],
+                                          {vm_config.name: vm_config.sec_group})[request])
+        ctx.warm_pool.attach(server, ports)
+        print(f'正在创建虚拟机 {vm_config.name}...OK (取自预热池)')
+        return server, [port.id for port in ports]
+
+    def server_task(vm_config):
+        vm_config.sec_group = result(secgroup_of[vm_config.name])
+        networks = []
+        for vm_ip in vm_config.ip_address:
+            cidr_prefix = str(vm_ip.cidr)
+            vm_config.networks.append(result(f'network:{cidr_prefix}'))
+            if port_first:
+                networks.append({"port": port_of(vm_config, vm_ip).id})
             else:
-                ip_address = server.addresses
-                ip_list = [ip_address[net][0]['addr'] for net in ip_address.keys()]
-                print(f"|{server.name}\t|\t{ip_list}\t|\t{server.admin_password}|")
+                networks.append({"uuid": result(f'subnet:{cidr_prefix}').network_id, "fixed_ip": vm_ip.ip})
+        server, warm_ports = claim_task(vm_config)
+        if server is None:
+            server = create_vm(conn=ctx.connection, vm_cfg=vm_config, networks=networks, resolver=ctx.resolver)
+        vm_config.update(server)
+        record = {'id': server.id, 'admin_password': server.admin_password}
+        if warm_ports:
+            # down --return-to-pool 时归还到预热池
+            record['ports'] = warm_ports
+            record['warm'] = True
+        elif port_first:
+            record['ports'] = [network['port'] for network in networks]
+        ctx.record('servers', vm_config.name, value=record)
+        emit('created', 'server', vm_config.name, id=server.id, warm=bool(warm_ports))
+        return server
+
+    def boot_task(vm_config):
+        # 同时启动中的虚拟机数量受 boot_slots 限制, 等待启动完成后释放
+        if ctx.boot_slots is None:
+            return server_task(vm_config)
+        ctx.boot_slots.acquire()
+        try:
+            return server_task(vm_config)
+        except Exception:
+            ctx.boot_slots.release()
+            raise
 
+    def wait_task(vm_config):
+        try:
+            server = ctx.poller.wait_for(vm_config.server)
+            # 需要浮动ip的虚拟机在绑定后才算就绪
+            if vm_config.have_float_ip != 'yes':
+                ready(vm_config, server)
+            return server
         except openstack.exceptions.ResourceTimeout: # type: ignore
             print(f'{vm_config.server.name} 等待超时! ')
-            if vm_config.have_float_ip == 'yes':
-                floatip = add_float_ip(connection, server, vm_config.float_ip_bind)
-                ip_address = server.addresses
-                vm_config.float_ip = floatip.floating_ip_address
-                ip_list = [ip_address[net][0]['addr'] for net in ip_address.keys()]
-                print(f"|{server.name}\t|\t{ip_list}:{vm_config.float_ip}\t|\t{server.admin_password}|")
+            emit('failed', 'server', vm_config.name, id=vm_config.server.id, error='等待超时')
+            return vm_config.server
+        except openstack.exceptions.ResourceFailure as err: # type: ignore
+            emit('failed', 'server', vm_config.name, id=vm_config.server.id, error=str(err))
+            raise
+        finally:
+            if ctx.boot_slots is not None:
+                ctx.boot_slots.release()
+
+    def float_ip_task(vm_config):
+        server = result(f'wait:{vm_config.name}')
+        port_id = None
+        if port_first:
+            port_id = next(port_of(vm_config, vm_ip).id for vm_ip in vm_config.ip_address
+                           if str(vm_ip.ip) == vm_config.float_ip_bind)
+        floatip = add_float_ip(ctx.connection, server, vm_config.float_ip_bind, ctx.resolver, port_id, ctx.fip_pool)
+        vm_config.float_ip = floatip.floating_ip_address
+        ctx.record('servers', vm_config.name, 'floating_ip', value={
+            'id': floatip.id, 'address': floatip.floating_ip_address, 'port_id': floatip.port_id})
+        emit('created', 'floating_ip', vm_config.name, id=floatip.id, address=floatip.floating_ip_address)
+        ready(vm_config, server)
+        return floatip
+
+    def router_task():
+        router = create_router(ctx.connection, 'provider', ctx.resolver)
+        ctx.record('router', 'id', value=router.id)
+        emit('created', 'router', router.name, id=router.id)
+        return router
+
+    # 根据配置文件创建路由
+    graph.add('router', 'router', router_task, ['project'])
+
+    def fip_pool_task():
+        ctx.fip_pool = FloatingIPPool(ctx.connection, ctx.resolver.network_id('provider'))
+        ctx.fip_pool.fill(float_count)
+
+    # 需要的浮动ip在虚拟机启动期间提前分配好
+    float_count = sum(vm_config.have_float_ip == 'yes' for vm_config in vm_list)
+    if float_count > 0:
+        graph.add('fip-pool', 'fip-pool', fip_pool_task, ['project'])
+
+    if port_first:
+        graph.add('ip-check', 'ip-check', ip_check_task, sorted(f'subnet:{cidr_prefix}' for cidr_prefix in port_requests))
+
+    for vm_config in vm_list:
+        server_deps = [secgroup_of[vm_config.name]]
+        for vm_ip in vm_config.ip_address:
+            cidr_prefix = str(vm_ip.cidr)
+            graph.add('network', f'network:{cidr_prefix}',
+                      lambda cidr_prefix=cidr_prefix: network_task(cidr_prefix), ['project'])
+            graph.add('subnet', f'subnet:{cidr_prefix}',
+                      lambda cidr_prefix=cidr_prefix: subnet_task(cidr_prefix),
+                      [f'network:{cidr_prefix}'])
+            if cidr_prefix in float_cidrs:
+                graph.add('router-interface', f'router-interface:{cidr_prefix}',
+                          lambda cidr_prefix=cidr_prefix: router_interface_task(cidr_prefix),
+                          ['router', f'subnet:{cidr_prefix}'])
+            if port_first:
+                graph.add('port', f'ports:{cidr_prefix}',
+                          lambda cidr_prefix=cidr_prefix: ports_task(cidr_prefix),
+                          ['ip-check'] + sorted({secgroup_of[vm_name] for vm_name, _ in port_requests[cidr_prefix]}))
+                server_deps.append(f'ports:{cidr_prefix}')
             else:
-                ip_address = server.addresses
-                ip_list = [ip_address[net][0]['addr'] for net in ip_address.keys()]
-                print(f"|{server.name}\t|\t{ip_list}\t|\t{server.admin_password}|")
-            continue
-        except openstack.exceptions.ResourceFailure as e:
-            print(f'{vm_config.server.name} 创建失败! {e}')
-            # TODO: 失败清理
+                server_deps.append(f'subnet:{cidr_prefix}')
+        graph.add('server', f'server:{vm_config.name}',
+                  lambda vm_config=vm_config: boot_task(vm_config), server_deps)
+        # 等待虚拟机启动只是等待后台轮询结果, 不占用并发名额
+        graph.add('wait', f'wait:{vm_config.name}',
+                  lambda vm_config=vm_config: wait_task(vm_config),
+                  [f'server:{vm_config.name}'], limited=False)
+        if vm_config.have_float_ip == 'yes':
+            float_cidr = next(str(vm_ip.cidr) for vm_ip in vm_config.ip_address
+                              if str(vm_ip.ip) == vm_config.float_ip_bind)
+            graph.add('floating-ip', f'floating-ip:{vm_config.name}',
+                      lambda vm_config=vm_config: float_ip_task(vm_config),
+                      [f'wait:{vm_config.name}', f'router-interface:{float_cidr}', 'fip-pool'])
+    return graph
+
+
+def up(filename='vm-config.yaml', parallel=4, cache_file=None, cache_ttl=3600, invalidate_cache=False,
+       dry_run=False, state_file=None, port_first=False, config=None, ctx=None):
+    """读取 YAML 配置文件并创建 VM
 
-def down(filename='vm-config.yaml'):
-    """根据YAML配置文件清理项目"""
+    整个构建过程为一个任务依赖图, 依赖满足的任务并发执行, parallel 指定同时执行的任务数量;
+    cache_file 指定镜像、配额和外部网络查询结果的本地缓存文件, 缓存在 cache_ttl 秒后过期,
+    invalidate_cache 为 True 时先清空缓存; dry_run 为 True 时只打印任务图和关键路径;
+    创建的资源ID记录在 state_file 中, 默认放在配置文件旁边;
+    port_first 为 True 时先按指定ip批量创建端口, 再以端口启动虚拟机;
+    批量构建时由调用方传入已解析的 config 和带有共用资源的 ctx
+    """
+    config = config or Config(filename)
+    vm_list = config.parse_vm()
+    ctx = ctx or Context()
+    graph = plan_up(config, vm_list, ctx, cache_file, cache_ttl, invalidate_cache, port_first)
+    if dry_run:
+        graph.print_plan()
+        return
+
+    ctx.state = State(state_file or default_state_file(filename))
+
+    events.emit('started', 'project', config.project_name, action='up', vms=len(vm_list))
+    failed = run_graph(graph, vm_list, parallel)
+    if ctx.fip_pool is not None:
+        ctx.fip_pool.release()
+    events.emit('finished', 'project', config.project_name, action='up',
+                failed=[task.name for task in failed])
+    print('openstack 项目构建完成!')
+
+def up_events(filename='vm-config.yaml', **kwargs):
+    """以生成器的方式执行 up, 逐个返回构建过程中的事件, 参数与 up 相同
+
+    每台虚拟机就绪时返回 event 为 ready 的事件 (包含ip、浮动ip和管理员密码), 调用方可以立即开始后续操作:
+        for event in up_events('lab.yaml'):
+            if event['event'] == 'ready':
+                ...
+    """
+    return events.stream(up, filename, **kwargs)
+
+def run_graph(graph, vm_list, parallel):
+    """执行任务图, 并按配置文件顺序打印虚拟机信息"""
+    failed = graph.run(parallel)
+    for vm_config in vm_list:
+        task = graph.tasks[f'wait:{vm_config.name}']
+        if task.error is None:
+            print(format_vm(vm_config, task.result))
+    if failed:
+        print(f'[WARNING] {len(failed)} 个任务失败或被跳过: {", ".join(task.name for task in failed)}')
+        # TODO: 失败清理
+    return failed
+
+def format_vm(vm_config, server):
+    """返回要打印的结果行"""
+    # 管理员密码只在创建虚拟机的响应中返回, 列表查询的结果中没有
+    admin_password = vm_config.server.admin_password
+    ip_address = server.addresses
+    ip_list = [ip_address[net][0]['addr'] for net in ip_address.keys()]
+    if vm_config.float_ip:
+        return f"|{server.name}\t|\t{ip_list}:{vm_config.float_ip}\t|\t{admin_password}|"
+    return f"|{server.name}\t|\t{ip_list}\t|\t{admin_password}|"
+
+def plan(filename='vm-config.yaml', cache_file=None, cache_ttl=3600):
+    """对比配置文件和项目的实际状态, 打印需要变更的资源"""
     config = Config(filename)
+    vm_list = config.parse_vm()
+    admin_connection = connect_admin()
+    project = admin_connection.identity.find_project(name_or_id=config.project_name)
+    if project is None:
+        print(f'+ project {config.project_name}')
+        for vm_config in vm_list:
+            print(f'+ server {vm_config.name}')
+        return None, []
+    connection = connect_project(project.id, project.name)
+    resolver = Resolver(connection, cache_file, cache_ttl, auth_args()['auth_url'])
+    reconciler = Reconciler(connection, resolver)
+    changes = reconciler.diff(vm_list)
+    for change in changes:
+        print(change)
+    if not changes:
+        print('没有需要变更的资源')
+    return reconciler, changes
+
+def apply(filename='vm-config.yaml', parallel=4, cache_file=None, cache_ttl=3600, state_file=None,
+          port_first=False):
+    """只创建、重建或删除与配置文件不一致的资源, 项目不存在时执行完整的 up"""
+    reconciler, changes = plan(filename, cache_file, cache_ttl)
+    if reconciler is None:
+        up(filename, parallel, cache_file, cache_ttl, state_file=state_file, port_first=port_first)
+        return
+    if not changes:
+        return
+    connection = reconciler.connection
+    state = State(state_file or default_state_file(filename))
+    if not state.exists:
+        # 没有状态文件时项目中已有的资源都没有记录, 只记录本次变更的状态文件会让 down 漏删资源;
+        # 这时只在内存中记录, down 仍按名字查找项目内的资源
+        state = State(None)
+
+    def select(action, kind):
+        return [change for change in changes if change.action in action and change.kind == kind]
+
+    # 1.先删除: 虚拟机 -> 浮动ip -> 路由接口 -> 子网 -> 网络
+    teardown = Teardown(connection, parallel)
+    servers = [change.resource for change in select(('delete', 'replace'), 'server')]
+    if servers:
+        teardown.delete_servers(servers)
+        # 以端口启动的虚拟机删除后端口仍然保留, 要一起删除
+        teardown.delete_unbound_ports()
+    for change in select(('delete', 'replace'), 'server'):
+        state.remove('servers', change.name)
+    ips = [change.resource for change in select(('delete',), 'floating-ip')]
+    if ips:
+        teardown.delete_ips(ips)
+    for change in select(('delete',), 'floating-ip'):
+        state.remove('servers', change.name, 'floating_ip')
+    subnets = [change.resource for change in select(('delete',), 'subnet')]
+    if subnets:
+        teardown.remove_interfaces(reconciler.interfaces_of(subnets))
+        teardown.delete_subnets(subnets)
+        teardown.delete_networks([connection.network.get_network(subnet.network_id) for subnet in subnets])
+    for change in select(('delete',), 'subnet'):
+        state.remove('router', 'interfaces', change.name)
+        state.remove('networks', change.name)
+
+    # 2.再创建: 新增和重建的虚拟机走 up 的任务图, 所需的新网段随之创建
+    vm_list = [change.vm for change in select(('create', 'replace'), 'server')]
+    if vm_list:
+        config = Config(filename)
+        ctx = Context(connection, state)
+        ctx.resolver = reconciler.resolver
+        graph = plan_up(config, vm_list, ctx, cache_file, cache_ttl, port_first=port_first)
+        run_graph(graph, vm_list, parallel)
+        if ctx.fip_pool is not None:
+            ctx.fip_pool.release()
+
+    # 3.不需要重建的虚拟机只补绑浮动ip
+    float_changes = select(('create',), 'floating-ip')
+    if float_changes:
+        pool = FloatingIPPool(connection, reconciler.resolver.network_id('provider'), parallel)
+        pool.fill(len(float_changes))
+        for change in float_changes:
+            floatip = add_float_ip(connection, change.resource, change.vm.float_ip_bind, pool=pool)
+            state.set('servers', change.name, 'floating_ip', value={
+                'id': floatip.id, 'address': floatip.floating_ip_address, 'port_id': floatip.port_id})
+            print(f'绑定浮动ip {floatip.floating_ip_address} 到 {change.name}')
+        pool.release()
+    print('openstack 项目变更完成!')
+
+def down(filename='vm-config.yaml', parallel=8, state_file=None, config=None, return_to_pool=False):
+    """根据YAML配置文件清理项目, parallel 指定每层资源同时删除的数量
+
+    有状态文件时直接按记录的资源ID删除, 否则按名字查找项目内的资源;
+    配置了预热池时, return_to_pool 为 True 则把取自池中的虚拟机归还并保留项目, 否则池中的虚拟机一起删除
+    """
+    state = State(state_file or default_state_file(filename))
+    if state.exists:
+        down_by_state(state, parallel, return_to_pool)
+        return
+    config = config or Config(filename)
     project_name = config.project_name
     vm_list = config.parse_vm()
+    events.emit('started', 'project', project_name, action='down')
 
-    admin_connection = openstack.connect(**auth_args)
+    admin_connection = connect_admin()
     project = admin_connection.identity.find_project(name_or_id=project_name)
-    auth_args['project_name'] = project_name
-    auth_args['project_id'] = project.id
-    new_conn = openstack.connect(**auth_args)
-    for vm_cfg in vm_list:
-        delete_vm(new_conn, vm_cfg)
-    delete_float_ip(new_conn)
-    delete_route_network(new_conn)
-    delete_project(admin_connection, project)
+    new_conn = connect_project(project.id, project.name)
+    server_names = [vm_cfg.name for vm_cfg in vm_list]
+    keep_pool = False
+    if config.warm_pool:
+        pool = WarmPool(new_conn, parallel)
+        members = pool.members()
+        if return_to_pool:
+            pool.return_servers([server for server in members
+                                 if not pool.is_idle(server) and server.name in server_names])
+            server_names = [name for name in server_names
+                            if name not in {server.name for server in members}]
+            keep_pool = True
+        else:
+            server_names += [server.name for server in members if pool.is_idle(server)]
+    Teardown(new_conn, parallel).run(server_names)
+    if not keep_pool:
+        delete_project(admin_connection, project)
+        events.emit('deleted', 'project', project_name, id=project.id)
+    events.emit('finished', 'project', project_name, action='down', keep_pool=keep_pool)
+    if keep_pool:
+        print(f"项目 '{project_name}' 清理完成, 预热池保留在项目中。")
+        return
     print(f"项目 '{project_name}' 清理完成。")
 
+def down_events(filename='vm-config.yaml', **kwargs):
+    """以生成器的方式执行 down, 逐个返回清理过程中的事件, 参数与 down 相同"""
+    return events.stream(down, filename, **kwargs)
+
+def down_by_state(state, parallel=8, return_to_pool=False):
+    """按状态文件中记录的资源ID清理项目, 不再列表查询"""
+    project = state.get('project')
+    events.emit('started', 'project', project['name'], action='down')
+    connection = connect_project(project['id'], project['name'])
+    teardown = Teardown(connection, parallel)
+    servers = state.get('servers', default={})
+    server_ids = [server['id'] for server in servers.values()]
+    keep_pool = False
+    if state.get('warm_pool', default=False):
+        # 取自预热池的虚拟机归还, 池中空闲的虚拟机随项目一起删除
+        pool = WarmPool(connection, parallel)
+        members = pool.members()
+        if return_to_pool:
+            warm_ids = {server['id'] for server in servers.values() if server.get('warm')}
+            pool.return_servers([server for server in members if server.id in warm_ids])
+            server_ids = [server_id for server_id in server_ids if server_id not in warm_ids]
+            keep_pool = True
+        else:
+            server_ids += [server.id for server in members if pool.is_idle(server)]
+    teardown.delete_servers(server_ids)
+    teardown.delete_ports([port for server in servers.values() for port in server.get('ports', [])])
+    teardown.delete_secgroups(list(state.get('secgroups', default={}).values()))
+    # 浮动ip由服务端按项目过滤, 池中预先分配或复用但未记录的浮动ip一起释放
+    teardown.delete_ips(list(connection.network.ips(project_id=project['id'])))
+    router = state.get('router', default={})
+    if 'id' in router:
+        teardown.remove_interfaces(list(router.get('interfaces', {}).values()), router['id'])
+        teardown.delete_routers([router['id']])
+    networks = state.get('networks', default={}).values()
+    teardown.delete_subnets([network['subnet'] for network in networks if 'subnet' in network])
+    teardown.delete_networks([network['network'] for network in networks if 'network' in network])
+    if not keep_pool:
+        admin_connection = connect_admin()
+        delete_project(admin_connection, project['id'])
+        events.emit('deleted', 'project', project['name'], id=project['id'])
+    state.delete()
+    events.emit('finished', 'project', project['name'], action='down', keep_pool=keep_pool)
+    if keep_pool:
+        print(f"项目 '{project['name']}' 清理完成, 预热池保留在项目中。")
+        return
+    print(f"项目 '{project['name']}' 清理完成。")
+
+def pool_refill(filename='vm-config.yaml', parallel=4, cache_file=None, cache_ttl=3600):
+    """按配置中的 warm_pool 把项目内的预热池补足, 项目不存在时先创建项目
+
+    可以在 down --return-to-pool 之后或定时在后台执行
+    """
+    config = Config(filename)
+    if not config.warm_pool:
+        print(f'{filename} 中没有配置 warm_pool')
+        return
+    admin_connection = connect_admin()
+    project = admin_connection.identity.find_project(name_or_id=config.project_name)
+    if project is None:
+        connection, project = create_project(admin_connection, config.project_name, config.project_description)
+    else:
+        connection = connect_project(project.id, project.name)
+    resolver = Resolver(connection, cache_file, cache_ttl, auth_args()['auth_url'])
+    targets = {}
+    for item in config.warm_pool:
+        key = (resolver.image_id(item['image']), resolver.flavor_id(item['flavor']))
+        targets[key] = targets.get(key, 0) + int(item.get('size', 1))
+    WarmPool(connection, parallel).refill(targets, ServerPoller(connection))
+    print(f"项目 '{project.name}' 的预热池补充完成。")
+
+def status(filename='vm-config.yaml', state_file=None):
+    """根据状态文件和一次虚拟机列表查询打印项目中虚拟机的状态"""
+    state = State(state_file or default_state_file(filename))
+    if not state.exists:
+        print(f'状态文件 {state.path} 不存在, 请先执行 up')
+        return
+    project = state.get('project')
+    connection = connect_project(project['id'], project['name'])
+    servers = {server.id: server for server in connection.compute.servers(details=True, project_id=project['id'])}
+    print(f"项目 '{project['name']}':")
+    records = state.get('servers', default={})
+    # 按配置文件中的顺序打印, 配置中已经没有的虚拟机按名字排在后面
+    names = [vm.name for vm in Config(filename).parse_vm() if vm.name in records]
+    names += sorted(set(records) - set(names))
+    for name in names:
+        record = records[name]
+        server = servers.get(record['id'])
+        if server is None:
+            print(f"|{name}\t|\tNOT FOUND\t|")
+            continue
+        ip_address = server.addresses
+        ip_list = [ip_address[net][0]['addr'] for net in ip_address.keys()]
+        float_ip = f":{record['floating_ip']['address']}" if 'floating_ip' in record else ''
+        print(f"|{name}\t|\t{server.status}\t|\t{ip_list}{float_ip}\t|\t{record.get('admin_password')}|")
+
+def config_files(pattern):
+    """pattern 为目录时返回其中的 YAML 文件, 否则按通配符匹配, 按文件名排序"""
+    if os.path.isdir(pattern):
+        files = glob.glob(os.path.join(pattern, '*.yaml')) + glob.glob(os.path.join(pattern, '*.yml'))
+    else:
+        files = glob.glob(pattern)
+    return sorted(files)
+
+def validate(pattern):
+    """离线检查一个或多个配置文件 (文件、目录或通配符), 不访问 OpenStack, 返回有问题的文件数量"""
+    files = config_files(pattern)
+    if not files:
+        print(f'没有找到配置文件: {pattern}')
+        return 1
+    projects = {}
+    failed = 0
+    for filename in files:
+        project_name, problems = check_config(filename)
+        if project_name is not None:
+            if project_name in projects:
+                problems.append(f'项目名 {project_name} 与 {projects[project_name]} 重复')
+            projects.setdefault(project_name, filename)
+        if problems:
+            failed += 1
+            print(f'{filename}: FAILED')
+            for problem in problems:
+                print(f'    {problem}')
+        else:
+            print(f'{filename}: OK')
+    print(f'检查完成: {len(files)} 个配置文件, {failed} 个有问题')
+    return failed
+
+def batch_jobs(pattern, copies=0):
+    """返回批量执行的 (名称, 配置, 状态文件) 列表
+
+    copies 大于0时 pattern 为模板文件, 第 i 份配置中的 ${index} 替换为 i, 模板的项目名中
+    没有 ${index} 时在项目名后加上 -i; 否则 pattern 为目录或通配符, 匹配其中的 YAML 文件
+    """
+    jobs = []
+    if copies > 0:
+        base = os.path.splitext(pattern)[0]
+        # 模板中其他位置的 ${index} 可能不是合法的 YAML (如 10.0.${index}.0/24), 用序号0替换后再读取项目名
+        template_name = Config(pattern, {'index': 0}).project_name
+        for index in range(1, copies + 1):
+            config = Config(pattern, {'index': index})
+            if config.project_name == template_name:
+                config.project_name = f'{config.project_name}-{index}'
+            jobs.append((f'{pattern}#{index}', config, f'{base}-{index}.state.json'))
+    else:
+        for filename in config_files(pattern):
+            jobs.append((filename, Config(filename), default_state_file(filename)))
+    if not jobs:
+        raise ValueError(f'没有找到配置文件: {pattern}')
+    names = [config.project_name for _, config, _ in jobs]
+    duplicated = sorted({name for name in names if names.count(name) > 1})
+    if duplicated:
+        raise ValueError(f"项目名重复: {', '.join(duplicated)}")
+    return jobs
+
+def batch(action, pattern, copies=0, parallel=4, max_calls=32, max_booting=20,
+          cache_file=None, cache_ttl=3600, port_first=False, return_to_pool=False):
+    """在一个进程中对多个配置文件同时执行 up 或 down
+
+    所有项目共用一个管理员连接和镜像、配额、外部网络的查询结果; 整个进程同时进行的
+    API 调用不超过 max_calls 个, up 时同时启动中的虚拟机不超过 max_booting 台
+    """
+    jobs = batch_jobs(pattern, copies)
+    # 命令行已经开启调度时沿用, 否则在批量执行期间开启
+    owned = limiter.current() is None
+    if owned:
+        limiter.start(max_calls)
+    try:
+        if action == 'up':
+            resolver = Resolver(connect_admin(), cache_file, cache_ttl, auth_args()['auth_url'])
+            boot_slots = threading.BoundedSemaphore(max(max_booting, 1))
+
+        def run(job):
+            name, config, state_file = job
+            if action == 'up':
+                ctx = Context()
+                ctx.resolver = resolver
+                ctx.boot_slots = boot_slots
+                up(name, parallel, state_file=state_file, port_first=port_first, config=config, ctx=ctx)
+            else:
+                down(name, parallel, state_file, config=config, return_to_pool=return_to_pool)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = {executor.submit(run, job): job for job in jobs}
+            for future in as_completed(futures):
+                name, config, _ = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    print(f'[ERROR] {config.project_name} ({name}) 失败: {err}')
+                    failed.append(config.project_name)
+    finally:
+        if owned:
+            limiter.stop()
+    print(f'批量{action}完成: 成功 {len(jobs) - len(failed)} 个, 失败 {len(failed)} 个')
+    if failed:
+        print(f"失败的项目: {', '.join(failed)}")
+    return failed
+
+def run_action(args):
+    """执行命令行指定的动作"""
+    if args.batch or args.copies:
+        if args.action not in ('up', 'down'):
+            print('批量模式只支持 up/down')
+            return
+        batch(args.action, args.config, args.copies, args.parallel or (4 if args.action == 'up' else 8),
+              args.max_calls, args.max_booting, args.cache, args.cache_ttl, args.port_first, args.return_to_pool)
+    elif args.action == 'up':
+        up(args.config, args.parallel or 4, args.cache, args.cache_ttl, args.invalidate_cache, args.dry_run, args.state,
+           args.port_first)
+    elif args.action == 'plan':
+        plan(args.config, args.cache, args.cache_ttl)
+    elif args.action == 'apply':
+        apply(args.config, args.parallel or 4, args.cache, args.cache_ttl, args.state, args.port_first)
+    elif args.action == 'down':
+        down(args.config, args.parallel or 8, args.state, return_to_pool=args.return_to_pool)
+    elif args.action == 'status':
+        status(args.config, args.state)
+    elif args.action == 'validate':
+        if validate(args.config or 'vm-config.yaml'):
+            sys.exit(1)
+    elif args.action == 'pool' and args.subaction == 'refill':
+        pool_refill(args.config, args.parallel or 4, args.cache, args.cache_ttl)
+    else:
+        print('无效参数，请重试')
+
 def Usage():
     print(
 """
 需要命令行参数！
 Usage:
-    os_compose: <action> [-c/--config config file]
+    os_compose: <action> [-c/--config config file] [-p/--parallel N] [--cache [file]]
         action: up/down 创建或删除openstack 项目
+                status 根据状态文件打印虚拟机状态
+                plan/apply 对比配置与项目实际状态, 打印或只执行有差异的变更
+                pool refill 按配置中的 warm_pool 补足项目内预先启动的虚拟机
+                validate 离线检查配置文件, -c 可以是目录或通配符, 有问题时返回非零退出码
         -c/--config yaml配置文件路径
+        -p/--parallel 同时执行的任务数量(up, 默认为4)或每层同时删除的资源数量(down, 默认为8)
+        --dry-run 只打印 up 的任务依赖图和关键路径, 不实际创建
+        --cache 缓存镜像、配额和外部网络的查询结果, 可以指定缓存文件路径
+        --cache-ttl 缓存过期时间(秒), 默认为3600
+        --invalidate-cache 清空缓存后重新查询
+        --state 记录已创建资源ID的状态文件, 默认为配置文件同名的 .state.json 文件
+        --port-first 先按指定ip批量创建端口, 再以端口启动虚拟机
+        --return-to-pool down 时把取自预热池的虚拟机卸载网卡、重建后放回池中, 并保留项目
+        --batch -c 为目录或通配符, 在一个进程中同时对匹配的全部配置文件执行 up/down
+        --copies N -c 为模板文件, 生成 N 份配置批量执行, 模板中的 ${index} 替换为序号
+        --max-calls 整个进程同时进行的API调用数量, 默认为32
+        --service-limit 服务=N 单个服务的并发上限, 如 compute=8 network=16, 会随延迟和限流自动下调
+        --rate 每秒最多发出的API调用数量, 默认不限制
+        --retries 遇到 429/503 等可重试错误时的最大重试次数, 默认为5
+        --max-booting 批量模式下同时启动中的虚拟机数量, 默认为20
+        --token-cache [file] 缓存 token 和服务目录, 过期前连续执行的命令不再重新认证
+        --trace [file] 记录每次API调用的阶段和耗时并打印汇总, 可以导出为 .jsonl 或 Chrome trace 文件
+        --events [target] 以 JSON lines 输出资源创建、就绪、失败、删除事件, 默认写到标准输出(其他输出改到标准错误),
+                          也可以是文件、tcp://host:port 或 unix:///path
 """
     )
 
@@ -436,13 +1053,57 @@ if __name__ == '__main__':
         Usage()
         exit()
     parser = argparse.ArgumentParser(description='os_compose')
-    parser.add_argument('action', type=str, help='要执行的动作：up/down')
+    parser.add_argument('action', type=str, help='要执行的动作：up/down/plan/apply/status/pool/validate')
+    parser.add_argument('subaction', type=str, nargs='?', default=None, help='pool 的子命令: refill')
     parser.add_argument('-c', '--config', type=str, help='配置文件路径')
+    parser.add_argument('-p', '--parallel', type=int, default=None, help='同时创建或删除的资源数量')
+    parser.add_argument('--cache', type=str, nargs='?', const=DEFAULT_CACHE_FILE, default=None,
+                        help='缓存镜像、配额和外部网络的查询结果')
+    parser.add_argument('--cache-ttl', type=int, default=3600, help='缓存过期时间(秒)')
+    parser.add_argument('--invalidate-cache', action='store_true', help='清空缓存后重新查询')
+    parser.add_argument('--dry-run', action='store_true', help='只打印任务依赖图和关键路径')
+    parser.add_argument('--state', type=str, default=None, help='状态文件路径')
+    parser.add_argument('--port-first', action='store_true', help='先批量创建端口, 再以端口启动虚拟机')
+    parser.add_argument('--return-to-pool', action='store_true', help='down 时把取自预热池的虚拟机放回池中')
+    parser.add_argument('--batch', action='store_true', help='对目录或通配符匹配的全部配置文件执行')
+    parser.add_argument('--copies', type=int, default=0, help='由模板生成的配置份数')
+    parser.add_argument('--max-calls', type=int, default=32, help='同时进行的API调用数量')
+    parser.add_argument('--service-limit', type=str, nargs='+', default=None, help='单个服务的并发上限, 如 compute=8')
+    parser.add_argument('--rate', type=float, default=0, help='每秒最多发出的API调用数量')
+    parser.add_argument('--retries', type=int, default=5, help='可重试错误的最大重试次数')
+    parser.add_argument('--max-booting', type=int, default=20, help='批量模式下同时启动中的虚拟机数量')
+    parser.add_argument('--token-cache', type=str, nargs='?', const=DEFAULT_TOKEN_CACHE, default=None,
+                        help='缓存 token 和服务目录')
+    parser.add_argument('--trace', type=str, nargs='?', const='', default=None,
+                        help='记录API调用并打印汇总, 可以指定导出文件')
+    parser.add_argument('--events', type=str, nargs='?', const='-', default=None,
+                        help='以 JSON lines 输出事件, 可以指定文件或 tcp://、unix:// 地址')
     args = parser.parse_args()
-    if args.action == 'up':
-        up(args.config)
-    elif args.action == 'down':
-        down(args.config)
-    else:
-        print('无效参数，请重试')
-    
\ No newline at end of file
+    # 需要访问 OpenStack 的命令先检查连接信息, 缺少时直接退出
+    if args.action != 'validate' and not args.dry_run:
+        try:
+            auth_args()
+        except RuntimeError as err:
+            print(f'[ERROR] {err}')
+            sys.exit(1)
+    if args.token_cache:
+        token_cache = TokenCache(args.token_cache)
+    if args.trace is not None:
+        trace.start()
+    limiter.start(args.max_calls, rate=args.rate, limits=parse_service_limits(args.service_limit),
+                  retries=args.retries)
+    sink = events.subscribe(events.JsonLinesSink(args.events)) if args.events is not None else None
+    # 事件写到标准输出时, 其余输出改到标准错误, 标准输出只有 JSON lines
+    with contextlib.redirect_stdout(sys.stderr) if sink and sink.to_stdout else contextlib.nullcontext():
+        with trace.phase(args.action):
+            run_action(args)
+        limiter.stop().summary()
+        if args.trace is not None:
+            tracer = trace.stop()
+            tracer.summary()
+            if args.trace:
+                tracer.export(args.trace)
+                print(f'调用记录已导出到 {args.trace}')
+    if sink is not None:
+        events.unsubscribe(sink)
+        sink.close()